@@ -0,0 +1,102 @@
+"""Сравнение извлечения содержимого писем до и после перехода
+на однопроходный обход.
+
+Запуск из каталога email_bot_web:
+
+    python -m benchmarks.mime_extract [количество повторов]
+
+Для каждого письма из fixtures выводится среднее время извлечения
+в микросекундах и объем извлеченного текста в килобайтах.
+"""
+import sys
+import time
+from email import message_from_bytes
+from email.message import Message
+from pathlib import Path
+from typing import Any, Callable
+
+from infrastructure.imap_parser import (
+    decode_header_value,
+    extract_message_content,
+)
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+DEFAULT_ROUNDS = 300
+
+
+def old_extract_text_parts(message: Message) -> list[str]:
+    """Извлечь текстовые части из письма, как до однопроходного
+    обхода: обе версии multipart/alternative."""
+    text_parts = []
+    if message.is_multipart():
+        for part in message.get_payload():
+            if part.get_content_type() in ('text/plain', 'text/html'):
+                text_parts.append(part.get_payload(decode=True).decode())
+            elif part.is_multipart():
+                text_parts.extend(old_extract_text_parts(part))
+    else:
+        text_parts.append(message.get_payload(decode=True).decode())
+    return text_parts
+
+
+def old_extract_attach_names(message: Message) -> list[str]:
+    """Извлечь названия приложенных файлов вторым обходом письма."""
+    attach_names = []
+    for part in message.walk():
+        if part.get_content_type() not in ('text/plain', 'text/html'):
+            attachment_filename = part.get_filename()
+            if attachment_filename:
+                attach_names.append(decode_header_value(attachment_filename))
+    return attach_names
+
+
+def old_extract_content(message: Message) -> dict[str, list[str]]:
+    """Извлечь текст и названия вложений двумя обходами."""
+    return {
+        'Text': old_extract_text_parts(message),
+        'Attachments': old_extract_attach_names(message),
+    }
+
+
+def measure(
+    func: Callable[[Message], dict[str, Any]],
+    message: Message,
+    rounds: int,
+) -> tuple[float, dict[str, Any]]:
+    """Среднее время вызова func в микросекундах и его результат."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func(message)
+    return (time.perf_counter() - start) / rounds * 1e6, result
+
+
+def text_size(content: dict[str, Any]) -> float:
+    """Объем извлеченного текста в килобайтах."""
+    return len(''.join(content['Text']).encode()) / 1024
+
+
+def main(rounds: int) -> None:
+    print(
+        f'{"fixture":16} {"old us":>8} {"new us":>8} '
+        f'{"old KB":>8} {"new KB":>8}  attachments',
+    )
+    for path in sorted(FIXTURES_DIR.glob('*.eml')):
+        message = message_from_bytes(path.read_bytes())
+        old_time, old_content = measure(old_extract_content, message, rounds)
+        new_time, new_content = measure(
+            extract_message_content,
+            message,
+            rounds,
+        )
+        same_attachments = (
+            old_content['Attachments'] == new_content['Attachments']
+        )
+        print(
+            f'{path.stem:16} {old_time:8.0f} {new_time:8.0f} '
+            f'{text_size(old_content):8.1f} {text_size(new_content):8.1f}  '
+            f'{"same" if same_attachments else "differ"}',
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ROUNDS)
@@ -36,15 +36,8 @@ class LifespanApp:
         """Обработка событий жизненного цикла."""
         message = await receive()
         if message['type'] == 'lifespan.startup':
-            await self.startup()
             await send({'type': 'lifespan.startup.complete'})
 
-    async def startup(self) -> None:
-        """Обработчик события запуска жизненного цикла.
-        Перезапускает клиенты IMAP."""
-        from infrastructure.utils import on_startup_imap_starter
-        await on_startup_imap_starter()
-
 
 django_asgi_app = ASGIStaticFilesHandler(get_asgi_application())
 application = LifespanApp(django_asgi_app)
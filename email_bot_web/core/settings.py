@@ -100,6 +100,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REDIS_HOST = os.getenv('REDIS_HOST')
 REDIS_PORT = os.getenv('REDIS_PORT')
+REDIS_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
 
 CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
 CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
@@ -160,17 +161,83 @@ ALL_DOMAINS_KEY = 'domains_all'
 BOX_FULL_KEY = 'user_{telegram_id}_box_full_{box_id}'
 BOX_SIMPLE_KEY = 'user_{telegram_id}_box_simple_{box_id}'
 DOMAIN_KEY = 'domain_{id}'
-FILTERS_VALUE_KEY = 'user_{telegram_id}_box_filter_values_{box_id}'
+FILTERS_VALUE_KEY = 'user_{telegram_id}_box_filter_list_{box_id}'
+FILTERS_SEARCH_KEY = 'user_{telegram_id}_box_filter_search_{box_id}'
 USER_EXISTS_KEY = 'user_{telegram_id}_exist'
 USER_IS_ACTIVE_KEY = 'user_{telegram_id}_is_active'
 USER_BOXES_KEY = 'user_{telegram_id}_boxes'
 USER_KEY = 'user_{telegram_id}'
 USER_KEYS_PATTERN = 'user_{telegram_id}*'
 
+BOX_UID_STATE_KEY = 'user_{telegram_id}_box_uid_state_{box_id}'
+VERIFIED_CONNECTION_KEY = 'imap_verified_{digest}'
+VERIFIED_CONNECTION_TTL = int(
+    os.getenv('VERIFIED_CONNECTION_TTL', default=300),
+)
 REDIS_KEY_FORMAT = 'user_{telegram_id}_{box_id}_status'
 ACTIVE_VALUE = 'true'
 NON_ACTIVE_VALUE = 'false'
 
+RECONNECT_BASE_DELAY = int(os.getenv('RECONNECT_BASE_DELAY', default=1))
+RECONNECT_MAX_DELAY = int(os.getenv('RECONNECT_MAX_DELAY', default=300))
+RECONNECT_MAX_RETRIES = int(os.getenv('RECONNECT_MAX_RETRIES', default=10))
+RECONNECT_COOLDOWN = int(os.getenv('RECONNECT_COOLDOWN', default=3600))
+BACKLOG_CONCURRENCY = int(os.getenv('BACKLOG_CONCURRENCY', default=5))
+BACKLOG_MAX_MESSAGES = int(os.getenv('BACKLOG_MAX_MESSAGES', default=100))
+BACKLOG_MAX_BODY_CHECKS = int(
+    os.getenv('BACKLOG_MAX_BODY_CHECKS', default=100),
+)
+FULL_FETCH_MAX_SIZE = int(os.getenv('FULL_FETCH_MAX_SIZE', default=262144))
+TEXT_PART_MAX_SIZE = int(os.getenv('TEXT_PART_MAX_SIZE', default=262144))
+SERVER_SEARCH_MAX_FILTERS = int(
+    os.getenv('SERVER_SEARCH_MAX_FILTERS', default=10),
+)
+LISTENER_CONTROL_CHANNEL = 'imap_listener_control'
+LISTENER_START_ACTION = 'start'
+LISTENER_STOP_ACTION = 'stop'
+LISTENER_FILTERS_ACTION = 'filters'
+FILTER_INDEX_TTL = int(os.getenv('FILTER_INDEX_TTL', default=300))
+PUBSUB_RECONNECT_MAX_DELAY = int(
+    os.getenv('PUBSUB_RECONNECT_MAX_DELAY', default=30),
+)
+LISTENER_NODES_KEY = 'listener_nodes'
+LISTENER_LEASE_KEY = 'listener_lease_{box_id}'
+LISTENER_NODE_TTL = int(os.getenv('LISTENER_NODE_TTL', default=30))
+LISTENER_LEASE_TTL = int(os.getenv('LISTENER_LEASE_TTL', default=60))
+LISTENER_REBALANCE_INTERVAL = int(
+    os.getenv('LISTENER_REBALANCE_INTERVAL', default=10),
+)
+IDLE_TIMEOUT_KEY = 'imap_idle_timeout_{host}'
+IDLE_MAX_TIMEOUT = int(os.getenv('IDLE_MAX_TIMEOUT', default=1740))
+IDLE_MIN_TIMEOUT = int(os.getenv('IDLE_MIN_TIMEOUT', default=60))
+IDLE_TIMEOUT_TTL = int(os.getenv('IDLE_TIMEOUT_TTL', default=86400))
+TCP_KEEPALIVE_IDLE = int(os.getenv('TCP_KEEPALIVE_IDLE', default=60))
+TCP_KEEPALIVE_INTERVAL = int(os.getenv('TCP_KEEPALIVE_INTERVAL', default=20))
+TCP_KEEPALIVE_COUNT = int(os.getenv('TCP_KEEPALIVE_COUNT', default=3))
+POLL_WHEEL_SIZE = int(os.getenv('POLL_WHEEL_SIZE', default=3600))
+HOST_MAX_CONNECTS = int(os.getenv('HOST_MAX_CONNECTS', default=10))
+HOST_CONNECT_RATE = float(os.getenv('HOST_CONNECT_RATE', default=2))
+HOST_CONNECT_BURST = int(os.getenv('HOST_CONNECT_BURST', default=5))
+HOST_WAIT_WARNING = int(os.getenv('HOST_WAIT_WARNING', default=5))
+LISTENER_STATS_INTERVAL = int(os.getenv('LISTENER_STATS_INTERVAL', default=60))
+BREAKER_FAILURE_THRESHOLD = int(
+    os.getenv('BREAKER_FAILURE_THRESHOLD', default=5),
+)
+BREAKER_FAILURE_WINDOW = int(os.getenv('BREAKER_FAILURE_WINDOW', default=60))
+BREAKER_OPEN_TIME = int(os.getenv('BREAKER_OPEN_TIME', default=30))
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', default=60))
+HOST_CAPABILITIES_KEY = 'imap_capabilities_{host}'
+CAPABILITIES_TTL = int(os.getenv('CAPABILITIES_TTL', default=86400))
+STARTUP_CONCURRENCY = int(os.getenv('STARTUP_CONCURRENCY', default=50))
+STARTUP_RAMP_INTERVAL = float(
+    os.getenv('STARTUP_RAMP_INTERVAL', default=0.05),
+)
+STARTUP_LOGIN_TIMEOUT = int(os.getenv('STARTUP_LOGIN_TIMEOUT', default=60))
+PARSE_OFFLOAD_MIN_SIZE = int(
+    os.getenv('PARSE_OFFLOAD_MIN_SIZE', default=131072),
+)
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', default=2))
+
 CACHE_TIMEOUT = int(os.getenv('CACHE_TIMEOUT', default=3600))
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
@@ -1,3 +1,5 @@
+from asgiref.sync import async_to_sync
+
 from django.contrib import admin
 from django.db.models import Count
 from django.http import HttpRequest
@@ -11,6 +13,10 @@ from email_service.admin_actions import (
     delete_filters,
 )
 from email_service.models import BoxFilter, EmailBox, EmailService
+from infrastructure.imap_connection import (
+    STRATEGY_CAPABILITIES,
+    capability_cache,
+)
 
 
 @admin.register(EmailBox)
@@ -61,8 +67,24 @@ class BoxAdmin(admin.ModelAdmin):
 class EmailServiceAdmin(admin.ModelAdmin):
     """Админ-панель модели почтового сервиса."""
 
-    list_display = ('id', 'title', 'slug', 'address', 'port')
-    list_editable = ('slug', 'address', 'port', 'title')
+    list_display = (
+        'id',
+        'title',
+        'slug',
+        'address',
+        'port',
+        'poll_interval',
+        'use_compression',
+        'imap_mode',
+    )
+    list_editable = (
+        'slug',
+        'address',
+        'port',
+        'title',
+        'poll_interval',
+        'use_compression',
+    )
     ordering = ('id',)
     list_per_page = 50
     actions = (delete_domain_cache, delete_domains)
@@ -73,13 +95,33 @@ class EmailServiceAdmin(admin.ModelAdmin):
             del actions['delete_selected']
         return actions
 
+    @admin.display(description='Режим IMAP')
+    def imap_mode(self, obj: EmailService) -> str:
+        """Вывод режима прослушивания и расширений сервера."""
+        capabilities = async_to_sync(capability_cache.get)(obj.address)
+        if capabilities is None:
+            return 'Нет данных'
+        mode = 'IDLE' if 'IDLE' in capabilities else 'Опрос'
+        extensions = [
+            capability for capability in STRATEGY_CAPABILITIES
+            if capability != 'IDLE' and capability in capabilities
+        ]
+        return ', '.join([mode, *extensions])
+
 
 @admin.register(BoxFilter)
 class FilterAdmin(admin.ModelAdmin):
     """Админ-панель модели фильтра почтового ящика."""
 
-    list_display = ('id', 'box_id', 'filter_value', 'filter_name')
-    readonly_fields = ('box_id', 'filter_value', 'filter_name')
+    list_display = (
+        'id',
+        'box_id',
+        'filter_value',
+        'filter_name',
+        'filter_type',
+    )
+    readonly_fields = ('box_id', 'filter_value', 'filter_name', 'filter_type')
+    list_filter = ('filter_type',)
     search_fields = ('filter_value',)
     actions = (delete_filters,)
     ordering = ('id',)
@@ -22,6 +22,9 @@ def delete_domain_cache(
     for domain in queryset:
         key = settings.DOMAIN_KEY.format(id=domain.id)
         async_to_sync(redis_client.delete)(key)
+        async_to_sync(redis_client.delete)(
+            settings.HOST_CAPABILITIES_KEY.format(host=domain.address),
+        )
     async_to_sync(redis_client.delete)(settings.ALL_DOMAINS_KEY)
 
 
@@ -70,12 +73,24 @@ def delete_boxes(
                 telegram_id=box.user_id.telegram_id,
                 box_id=box.id,
             ),
+            settings.FILTERS_SEARCH_KEY.format(
+                telegram_id=box.user_id.telegram_id,
+                box_id=box.id,
+            ),
             settings.REDIS_KEY_FORMAT.format(
                 telegram_id=box.user_id.telegram_id,
                 box_id=box.id,
-            )
+            ),
+            settings.BOX_UID_STATE_KEY.format(
+                telegram_id=box.user_id.telegram_id,
+                box_id=box.id,
+            ),
         ]
         async_to_sync(redis_client.delete_many)(redis_keys)
+        async_to_sync(box_service.stop_listener)(
+            telegram_id=box.user_id.telegram_id,
+            box_id=box.id,
+        )
     queryset.delete()
     messages.success(request, 'Ящики удалены')
 
@@ -93,13 +108,20 @@ def delete_filters(
                 telegram_id=filter.box_id.user_id.telegram_id,
                 box_id=filter.box_id.id,
             ),
+            settings.FILTERS_SEARCH_KEY.format(
+                telegram_id=filter.box_id.user_id.telegram_id,
+                box_id=filter.box_id.id,
+            ),
             settings.BOX_FULL_KEY.format(
                 telegram_id=filter.box_id.user_id.telegram_id,
                 box_id=filter.box_id.id,
             ),
         ]
         async_to_sync(redis_client.delete_many)(redis_keys)
+    box_ids = set(queryset.values_list('box_id', flat=True))
     queryset.delete()
+    for box_id in box_ids:
+        async_to_sync(box_service.repo.filter.notify_changed)(box_id)
     messages.success(request, 'Фильтры удалены')
 
 
@@ -0,0 +1,26 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from infrastructure.utils import run_listener_service
+
+
+class Command(BaseCommand):
+    """Запуск сервиса прослушивания почтовых ящиков."""
+
+    help = 'Запустить прослушивание активных почтовых ящиков.'
+
+    def handle(self, *args, **options) -> None:
+        asyncio.run(self.serve())
+
+    async def serve(self) -> None:
+        """Работать до получения сигнала остановки."""
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, task.cancel)
+        try:
+            await run_listener_service()
+        except asyncio.CancelledError:
+            self.stdout.write('IMAP listeners stopped.')
@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0003_alter_emailbox_email_username'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailservice',
+            name='poll_interval',
+            field=models.PositiveIntegerField(default=60, verbose_name='Интервал опроса без IDLE, с'),
+        ),
+    ]
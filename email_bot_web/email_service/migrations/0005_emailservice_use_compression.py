@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0004_emailservice_poll_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailservice',
+            name='use_compression',
+            field=models.BooleanField(default=True, verbose_name='Сжатие трафика IMAP'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_service', '0005_emailservice_use_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boxfilter',
+            name='filter_type',
+            field=models.CharField(choices=[('sender', 'Отправитель'), ('subject', 'Ключевое слово в теме'), ('body', 'Ключевое слово в тексте')], default='sender', max_length=16, verbose_name='Тип фильтра'),
+        ),
+    ]
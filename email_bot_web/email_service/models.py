@@ -14,6 +14,14 @@ class EmailService(models.Model):
     slug = models.SlugField(verbose_name='Slug сервиса', unique=True)
     address = models.CharField(max_length=256, verbose_name='Адрес сервера')
     port = models.PositiveIntegerField(verbose_name='Порт сервера')
+    poll_interval = models.PositiveIntegerField(
+        default=60,
+        verbose_name='Интервал опроса без IDLE, с',
+    )
+    use_compression = models.BooleanField(
+        default=True,
+        verbose_name='Сжатие трафика IMAP',
+    )
 
     class Meta:
         verbose_name = 'Почтовый сервис'
@@ -53,6 +61,14 @@ class EmailBox(models.Model):
         return self.email_username
 
 
+class FilterType(models.TextChoices):
+    """Типы фильтров почтового ящика."""
+
+    SENDER = 'sender', 'Отправитель'
+    SUBJECT = 'subject', 'Ключевое слово в теме'
+    BODY = 'body', 'Ключевое слово в тексте'
+
+
 class BoxFilter(models.Model):
     """Модель фильтра почтового ящика."""
 
@@ -72,6 +88,12 @@ class BoxFilter(models.Model):
         null=True,
         blank=True,
     )
+    filter_type = models.CharField(
+        max_length=16,
+        choices=FilterType.choices,
+        default=FilterType.SENDER,
+        verbose_name='Тип фильтра',
+    )
 
     class Meta:
         verbose_name = 'Фильтр'
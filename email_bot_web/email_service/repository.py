@@ -1,6 +1,6 @@
 from django.conf import settings
 
-from email_service.models import BoxFilter, EmailBox, EmailService
+from email_service.models import BoxFilter, EmailBox, EmailService, FilterType
 from email_service.schemas import BoxFilterBase, EmailBoxIn
 from infrastructure.redis_service import redis_client
 from user.models import BotUser
@@ -29,9 +29,20 @@ class RepositoryBoxFilter:
     def __init__(self):
         self.model = BoxFilter
 
+    async def notify_changed(self, box_id: int) -> None:
+        """Сообщить сервису прослушивания об изменении фильтров ящика."""
+        await redis_client.publish(
+            settings.LISTENER_CONTROL_CHANNEL,
+            {
+                'action': settings.LISTENER_FILTERS_ACTION,
+                'box_id': box_id,
+            },
+        )
+
     @redis_client.delete_cache(
         key_format_list=[
             settings.FILTERS_VALUE_KEY,
+            settings.FILTERS_SEARCH_KEY,
             settings.BOX_FULL_KEY,
             settings.USER_BOXES_KEY,
         ],
@@ -43,17 +54,22 @@ class RepositoryBoxFilter:
         box_object: EmailBox,
         filter_value: str,
         filter_name: str,
+        filter_type: str = FilterType.SENDER,
     ) -> tuple[BoxFilter, bool]:
         """Создать новый фильтр ящика."""
-        return await self.model.objects.aget_or_create(
+        result = await self.model.objects.aget_or_create(
             box_id=box_object,
             filter_value=filter_value,
             filter_name=filter_name,
+            filter_type=filter_type,
         )
+        await self.notify_changed(box_id)
+        return result
 
     @redis_client.delete_cache(
         key_format_list=[
             settings.FILTERS_VALUE_KEY,
+            settings.FILTERS_SEARCH_KEY,
             settings.BOX_FULL_KEY,
             settings.USER_BOXES_KEY,
         ],
@@ -71,9 +87,12 @@ class RepositoryBoxFilter:
             obj_to_create.append(self.model(
                 box_id=box_object,
                 filter_value=filter.filter_value,
-                filter_name=filter.filter_name
+                filter_name=filter.filter_name,
+                filter_type=filter.filter_type,
             ))
-        return await self.model.objects.abulk_create(obj_to_create)
+        filters = await self.model.objects.abulk_create(obj_to_create)
+        await self.notify_changed(box_id)
+        return filters
 
     @redis_client.cache_result(key_format=settings.FILTERS_VALUE_KEY)
     async def get_box_filters_value_list(
@@ -81,10 +100,12 @@ class RepositoryBoxFilter:
         box_id: int,
         telegram_id: int,
     ) -> list[tuple[str]]:
-        """Получить список значений фильтров почтового ящика."""
-        return [(f['filter_value'], f['filter_name'])  # type: ignore
+        """Получить список значений, имен и типов фильтров
+        почтового ящика."""
+        return [(f['filter_value'], f['filter_name'],  # type: ignore
+                 f['filter_type'])
                 async for f in self.model.objects.filter(box_id=box_id)
-                .values('filter_value', 'filter_name').all()]
+                .values('filter_value', 'filter_name', 'filter_type').all()]
 
 
 class RepositoryEmailBox:
@@ -161,3 +182,11 @@ class RepositoryEmailBox:
         return [box async for box in self.model.objects
                 .select_related('user_id', 'email_service')
                 .filter(is_active=True).all()]
+
+    async def get_active_box(self, box_id: int) -> EmailBox | None:
+        """Получить активный почтовый ящик со связанными объектами
+        пользователя и почтового домена."""
+        return await self.model.objects.select_related(
+            'user_id',
+            'email_service',
+        ).filter(id=box_id, is_active=True).afirst()
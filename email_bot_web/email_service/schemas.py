@@ -22,7 +22,7 @@ class BoxFilterBase(ModelSchema):
 
     class Config:
         model = BoxFilter
-        model_fields = ['filter_value', 'filter_name']
+        model_fields = ['filter_value', 'filter_name', 'filter_type']
 
 
 class EmailBoxIn(ModelSchema):
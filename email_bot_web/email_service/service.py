@@ -16,7 +16,7 @@ from infrastructure.exceptions import (
     DomainDoesNotExist,
     UserDoesNotExist,
 )
-from infrastructure.imap_service import IMAPClient, IMAPListener
+from infrastructure.imap_service import IMAPClient
 from infrastructure.redis_service import redis_client
 from infrastructure.repository import Repository
 
@@ -39,25 +39,27 @@ class ServiceEmailBox:
         self.repo = Repository()
         self.redis = redis_client
 
-    async def start_listener(
-        self,
-        host: str,
-        port: int,
-        username: str,
-        password: str,
-        telegram_id: int,
-        box_id: int,
-    ) -> None:
-        """Запустить слушатель."""
-        listener = IMAPListener(
-            host=host,
-            port=port,
-            username=username,
-            password=password,
-            telegram_id=telegram_id,
-            box_id=box_id,
+    async def start_listener(self, telegram_id: int, box_id: int) -> None:
+        """Передать сервису прослушивания команду запуска слушателя."""
+        await self.redis.publish(
+            settings.LISTENER_CONTROL_CHANNEL,
+            {
+                'action': settings.LISTENER_START_ACTION,
+                'telegram_id': telegram_id,
+                'box_id': box_id,
+            },
+        )
+
+    async def stop_listener(self, telegram_id: int, box_id: int) -> None:
+        """Передать сервису прослушивания команду остановки слушателя."""
+        await self.redis.publish(
+            settings.LISTENER_CONTROL_CHANNEL,
+            {
+                'action': settings.LISTENER_STOP_ACTION,
+                'telegram_id': telegram_id,
+                'box_id': box_id,
+            },
         )
-        await listener.start()
 
     async def create_box(
         self,
@@ -99,10 +101,6 @@ class ServiceEmailBox:
             settings.ACTIVE_VALUE,
         )
         await self.start_listener(
-            host=email_domain.address,
-            port=email_domain.port,
-            username=box_object.email_username,
-            password=encryptor.decrypt_data(box_object.email_password),
             telegram_id=telegram_id,
             box_id=box_object.id,
         )
@@ -168,14 +166,7 @@ class ServiceEmailBox:
             await self.redis.gen_key(telegram_id, box_id),
             settings.ACTIVE_VALUE,
         )
-        await self.start_listener(
-            host=box_object.email_service.address,
-            port=box_object.email_service.port,
-            username=box_object.email_username,
-            password=encryptor.decrypt_data(box_object.email_password),
-            telegram_id=telegram_id,
-            box_id=box_id,
-        )
+        await self.start_listener(telegram_id=telegram_id, box_id=box_id)
 
     async def deactivate_box(self, telegram_id: int, box_id: int) -> None:
         """Дективировать почтовый ящик."""
@@ -190,3 +181,8 @@ class ServiceEmailBox:
             await self.redis.gen_key(telegram_id, box_id),
             settings.NON_ACTIVE_VALUE,
         )
+        await self.stop_listener(telegram_id=telegram_id, box_id=box_id)
+        await self.redis.delete(settings.BOX_UID_STATE_KEY.format(
+            telegram_id=telegram_id,
+            box_id=box_id,
+        ))
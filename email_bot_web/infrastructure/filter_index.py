@@ -0,0 +1,223 @@
+import re
+import time
+from collections import deque
+from fnmatch import translate
+
+from django.conf import settings
+
+from email_service.models import FilterType
+from infrastructure.repository import Repository
+
+DOMAIN_EXACT = 0
+DOMAIN_SUBDOMAINS = 1
+
+repo = Repository()
+
+
+class DomainTrie:
+    """Префиксное дерево доменов по меткам справа налево.
+
+    Узел хранит имя фильтра, совпадающего с доменом целиком,
+    и имя фильтра, совпадающего со всеми его поддоменами.
+    """
+
+    def __init__(self):
+        self._root: dict = {}
+
+    def add(self, domain: str, name: str, subdomains: bool) -> None:
+        """Добавить домен или все его поддомены."""
+        node = self._root
+        for part in reversed(domain.split('.')):
+            node = node.setdefault(part, {})
+        node.setdefault(
+            DOMAIN_SUBDOMAINS if subdomains else DOMAIN_EXACT,
+            name,
+        )
+
+    def match(self, domain: str) -> str | None:
+        """Найти имя самого точного фильтра для домена."""
+        node = self._root
+        matched = None
+        parts = domain.split('.')
+        for index, part in enumerate(reversed(parts), start=1):
+            node = node.get(part)
+            if node is None:
+                return matched
+            if index == len(parts):
+                return node.get(DOMAIN_EXACT, matched)
+            matched = node.get(DOMAIN_SUBDOMAINS, matched)
+        return matched
+
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик для поиска ключевых слов в тексте.
+
+    Все ключевые слова ищутся за один проход по тексту, поэтому
+    время проверки не зависит от их числа. Регистр не учитывается.
+    """
+
+    def __init__(self, keywords: list[tuple[str, str]]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[str | None] = [None]
+        for keyword, label in keywords:
+            self._add(keyword.casefold(), label)
+        self._build()
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1
+
+    def _add(self, keyword: str, label: str) -> None:
+        """Добавить ключевое слово в бор."""
+        if not keyword:
+            return None
+        state = 0
+        for char in keyword:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        if self._output[state] is None:
+            self._output[state] = label
+
+    def _build(self) -> None:
+        """Построить суффиксные ссылки обходом бора в ширину."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+
+    def search(self, text: str) -> str | None:
+        """Найти первое ключевое слово в тексте и вернуть его подпись."""
+        state = 0
+        for char in text.casefold():
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._output[state] is not None:
+                return self._output[state]
+        return None
+
+
+class FilterIndex:
+    """Скомпилированные фильтры отправителей почтового ящика.
+
+    Поддерживаются значения фильтров вида:
+    user@company.com - точный адрес;
+    @company.com или *@company.com - любой адрес домена;
+    *.company.com или *@*.company.com - любой адрес поддоменов;
+    другие шаблоны с * - проверяются регулярным выражением.
+    Адреса и домены сравниваются без учета регистра.
+    Ключевые слова темы и текста письма ищутся автоматами.
+    """
+
+    def __init__(self, filters: list[tuple[str, str | None, str]]):
+        self._addresses: dict[str, str] = {}
+        self._domains = DomainTrie()
+        self._patterns: list[tuple[re.Pattern, str]] = []
+        keywords: dict[str, list[tuple[str, str]]] = {
+            FilterType.SUBJECT: [],
+            FilterType.BODY: [],
+        }
+        for value, name, filter_type in filters:
+            if filter_type in keywords:
+                keywords[filter_type].append((value, name or value))
+            else:
+                self.add(value, name or '')
+        self.subject_keywords = KeywordAutomaton(keywords[FilterType.SUBJECT])
+        self.body_keywords = KeywordAutomaton(keywords[FilterType.BODY])
+
+    def add(self, value: str, name: str) -> None:
+        """Добавить фильтр с именем отправителя name."""
+        value = value.strip().lower()
+        local, at, domain = value.rpartition('@')
+        if not at:
+            local, domain = '*', value
+        if local in ('', '*') and domain.startswith('*.'):
+            domain = domain[2:]
+            if '*' not in domain:
+                self._domains.add(domain, name, subdomains=True)
+                return None
+        elif local in ('', '*') and '*' not in domain:
+            self._domains.add(domain, name, subdomains=False)
+            return None
+        elif '*' not in value:
+            self._addresses.setdefault(value, name)
+            return None
+        self._patterns.append((re.compile(translate(value)), name))
+
+    def match(self, address: str) -> str | None:
+        """Получить имя отправителя из фильтра или None, если адрес
+        не подходит ни под один фильтр.
+
+        Для фильтров без имени возвращается пустая строка."""
+        address = address.lower()
+        if address in self._addresses:
+            return self._addresses[address]
+        name = self._domains.match(address.rpartition('@')[2])
+        if name is not None:
+            return name
+        for pattern, name in self._patterns:
+            if pattern.match(address):
+                return name
+        return None
+
+
+class FilterIndexCache:
+    """Скомпилированные фильтры ящиков в памяти слушателя.
+
+    Фильтры ящика компилируются при первой проверке письма
+    и сбрасываются по команде об изменении фильтров. Команды,
+    отправленные во время обрыва связи с redis, теряются, поэтому
+    фильтры также перекомпилируются не реже раза в FILTER_INDEX_TTL
+    секунд и сбрасываются при восстановлении подписки.
+    """
+
+    def __init__(self):
+        self._indexes: dict[int, tuple[FilterIndex, float]] = {}
+        self._versions: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._indexes)
+
+    async def get(self, box_id: int, telegram_id: int) -> FilterIndex:
+        """Получить скомпилированные фильтры ящика."""
+        index, expires = self._indexes.get(box_id, (None, 0.0))
+        if index is None or expires <= time.monotonic():
+            version = self._versions.get(box_id, 0)
+            index = FilterIndex(
+                await repo.filter.get_box_filters_value_list(
+                    box_id=box_id,
+                    telegram_id=telegram_id,
+                ),
+            )
+            if self._versions.get(box_id, 0) == version:
+                self._indexes[box_id] = (
+                    index,
+                    time.monotonic() + settings.FILTER_INDEX_TTL,
+                )
+        return index
+
+    def invalidate(self, box_id: int) -> None:
+        """Сбросить скомпилированные фильтры ящика.
+
+        Фильтры, загружаемые в момент сброса, не сохраняются."""
+        self._indexes.pop(box_id, None)
+        self._versions[box_id] = self._versions.get(box_id, 0) + 1
+
+    def clear(self) -> None:
+        """Сбросить скомпилированные фильтры всех ящиков."""
+        for box_id in list(self._indexes):
+            self.invalidate(box_id)
+
+
+filter_indexes: FilterIndexCache = FilterIndexCache()
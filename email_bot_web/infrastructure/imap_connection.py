@@ -0,0 +1,619 @@
+import asyncio
+import logging
+import re
+import socket
+import ssl
+import time
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from dataclasses import dataclass, field
+from email.parser import BytesFeedParser
+from typing import AsyncIterator, Callable
+
+import aioimaplib
+from django.conf import settings
+
+from infrastructure.error_messages import SERVER_UNAVAILABLE
+from infrastructure.exceptions import ServerUnavailable
+from infrastructure.redis_service import redis_client
+
+logger = logging.getLogger('imap')
+CONNECT_ERRORS = (asyncio.TimeoutError, OSError, ServerUnavailable)
+GREETING_CAPABILITY = re.compile(rb'\[CAPABILITY (?P<capabilities>[^\]]*)\]')
+STRATEGY_CAPABILITIES = (
+    'IDLE',
+    'CONDSTORE',
+    'QRESYNC',
+    'COMPRESS=DEFLATE',
+    'LITERAL+',
+)
+
+
+class TokenBucket:
+    """Ограничение частоты событий алгоритмом token bucket."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        """Пополнить ведро за прошедшее время."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+
+    async def take(self) -> None:
+        """Дождаться и забрать один токен."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return None
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostLimiter:
+    """Ограничение подключений к почтовым серверам.
+
+    Для каждого сервера ограничено число одновременных подключений
+    с входом и их частота, чтобы массовый перезапуск слушателей или
+    активация ящиков не упирались в ограничения провайдера. Время
+    ожидания разрешения собирается в статистику по серверам.
+    """
+
+    def __init__(self):
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._stats: dict[str, dict[str, float]] = {}
+
+    @asynccontextmanager
+    async def acquire(self, host: str) -> AsyncIterator[None]:
+        """Получить разрешение на подключение к серверу."""
+        semaphore = self._semaphores.setdefault(
+            host,
+            asyncio.Semaphore(settings.HOST_MAX_CONNECTS),
+        )
+        bucket = self._buckets.setdefault(
+            host,
+            TokenBucket(
+                settings.HOST_CONNECT_RATE,
+                settings.HOST_CONNECT_BURST,
+            ),
+        )
+        stats = self._stats.setdefault(
+            host,
+            {'connects': 0, 'active': 0, 'wait_total': 0.0, 'wait_max': 0.0},
+        )
+        started = time.monotonic()
+        async with semaphore:
+            await bucket.take()
+            waited = time.monotonic() - started
+            stats['connects'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+            if waited > settings.HOST_WAIT_WARNING:
+                logger.warning(
+                    f'HOST {host}. Waited {waited:.1f} s for connect.',
+                )
+            stats['active'] += 1
+            try:
+                yield
+            finally:
+                stats['active'] -= 1
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """Статистика ожидания подключений по серверам."""
+        return {
+            host: {
+                'connects': stats['connects'],
+                'active': stats['active'],
+                'wait_avg': round(
+                    stats['wait_total'] / (stats['connects'] or 1),
+                    3,
+                ),
+                'wait_max': round(stats['wait_max'], 3),
+            }
+            for host, stats in self._stats.items()
+        }
+
+
+host_limiter: HostLimiter = HostLimiter()
+
+
+@dataclass
+class CircuitState:
+    """Состояние предохранителя сервера."""
+
+    failures: deque = field(default_factory=deque)
+    opened_at: float | None = None
+    probing: bool = False
+    closed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class CircuitBreaker:
+    """Предохранитель подключений к почтовым серверам.
+
+    Если за BREAKER_FAILURE_WINDOW секунд к серверу не удалось
+    подключиться BREAKER_FAILURE_THRESHOLD раз, предохранитель
+    размыкается и подключения ко всем ящикам сервера приостанавливаются.
+    Через BREAKER_OPEN_TIME секунд пропускается одно пробное
+    подключение: при успехе предохранитель замыкается, при неудаче
+    пауза начинается заново.
+    """
+
+    def __init__(self):
+        self._states: dict[str, CircuitState] = {}
+
+    def _state(self, host: str) -> CircuitState:
+        """Получить состояние предохранителя сервера."""
+        state = self._states.get(host)
+        if state is None:
+            state = self._states[host] = CircuitState()
+            state.closed.set()
+        return state
+
+    def is_open(self, host: str) -> bool:
+        """Разомкнут ли предохранитель сервера."""
+        return self._state(host).opened_at is not None
+
+    def _admit(self, host: str) -> bool | None:
+        """Пропустить подключение к серверу.
+
+        При разомкнутом предохранителе пропускается только пробное
+        подключение после паузы. Возвращает None, если подключение
+        не пропущено, иначе признак пробного подключения."""
+        state = self._state(host)
+        if state.opened_at is None:
+            return False
+        if state.probing:
+            return None
+        if time.monotonic() - state.opened_at < settings.BREAKER_OPEN_TIME:
+            return None
+        logger.info(f'HOST {host}. Probing connection.')
+        state.probing = True
+        return True
+
+    async def _wait(self, host: str) -> bool:
+        """Дождаться возможности подключиться к серверу."""
+        probe = self._admit(host)
+        while probe is None:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._state(host).closed.wait(),
+                    timeout=settings.BREAKER_OPEN_TIME,
+                )
+            probe = self._admit(host)
+        return probe
+
+    @asynccontextmanager
+    async def attempt(
+        self,
+        host: str,
+        wait: bool = True,
+    ) -> AsyncIterator[None]:
+        """Пропустить подключение к серверу и учесть его результат.
+
+        Без wait при разомкнутом предохранителе сразу выбрасывается
+        ServerUnavailable. Ошибки соединения считаются неудачей,
+        остальные ошибки означают, что сервер ответил. Пробное
+        подключение освобождается при любом исходе, в том числе
+        при отмене."""
+        if wait:
+            probe = await self._wait(host)
+        else:
+            probe = self._admit(host)
+            if probe is None:
+                raise ServerUnavailable(SERVER_UNAVAILABLE)
+        try:
+            yield
+        except CONNECT_ERRORS:
+            self._failure(host, probe)
+            raise
+        except Exception:
+            self._success(host)
+            raise
+        else:
+            self._success(host)
+        finally:
+            if probe:
+                self._state(host).probing = False
+
+    def _success(self, host: str) -> None:
+        """Замкнуть предохранитель после удачного подключения."""
+        state = self._state(host)
+        if state.opened_at is not None:
+            logger.info(f'HOST {host}. Circuit closed.')
+        state.failures.clear()
+        state.opened_at = None
+        state.probing = False
+        state.closed.set()
+
+    def _failure(self, host: str, probe: bool) -> None:
+        """Учесть неудачное подключение и при необходимости
+        разомкнуть предохранитель."""
+        state = self._state(host)
+        now = time.monotonic()
+        if probe:
+            state.opened_at = now
+            return None
+        state.failures.append(now)
+        while state.failures[0] < now - settings.BREAKER_FAILURE_WINDOW:
+            state.failures.popleft()
+        threshold = settings.BREAKER_FAILURE_THRESHOLD
+        if state.opened_at is None and len(state.failures) >= threshold:
+            logger.warning(f'HOST {host}. Circuit opened.')
+            state.opened_at = now
+            state.closed.clear()
+
+    def stats(self) -> list[str]:
+        """Серверы с разомкнутым предохранителем."""
+        return [host for host in self._states if self.is_open(host)]
+
+
+host_breaker: CircuitBreaker = CircuitBreaker()
+
+
+class ResumableSSLContext(ssl.SSLContext):
+    """SSL контекст, возобновляющий последнюю TLS сессию сервера."""
+
+    session: ssl.SSLSession | None = None
+
+    def wrap_bio(
+        self,
+        incoming: ssl.MemoryBIO,
+        outgoing: ssl.MemoryBIO,
+        server_side: bool = False,
+        server_hostname: str | None = None,
+        session: ssl.SSLSession | None = None,
+    ) -> ssl.SSLObject:
+        return super().wrap_bio(
+            incoming,
+            outgoing,
+            server_side=server_side,
+            server_hostname=server_hostname,
+            session=session or self.session,
+        )
+
+
+class HostConnector:
+    """Общие для подключений к серверу SSL контекст и кэш адресов.
+
+    Повторные подключения к серверу возобновляют TLS сессию вместо
+    полного рукопожатия и не разрешают имя сервера заново в течение
+    DNS_CACHE_TTL секунд.
+    """
+
+    def __init__(self):
+        self._contexts: dict[str, ResumableSSLContext] = {}
+        self._addresses: dict[str, tuple[list[str], float]] = {}
+        self._handshakes = 0
+        self._resumed = 0
+
+    def ssl_context(self, host: str) -> ResumableSSLContext:
+        """Получить SSL контекст сервера."""
+        context = self._contexts.get(host)
+        if context is None:
+            context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+            self._contexts[host] = context
+        return context
+
+    async def resolve(self, host: str, port: int) -> list[str]:
+        """Получить адреса сервера из кэша или DNS."""
+        addresses, expires = self._addresses.get(host, ([], 0.0))
+        if addresses and expires > time.monotonic():
+            return addresses
+        address_info = await asyncio.get_running_loop().getaddrinfo(
+            host,
+            port,
+            type=socket.SOCK_STREAM,
+        )
+        addresses = list(dict.fromkeys(info[4][0] for info in address_info))
+        self._addresses[host] = (
+            addresses,
+            time.monotonic() + settings.DNS_CACHE_TTL,
+        )
+        return addresses
+
+    def forget_address(self, host: str) -> None:
+        """Удалить адрес сервера из кэша."""
+        self._addresses.pop(host, None)
+
+    def save_session(self, host: str, transport) -> None:
+        """Запомнить TLS сессию соединения для следующих подключений."""
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is None:
+            return None
+        self._handshakes += 1
+        if ssl_object.session_reused:
+            self._resumed += 1
+        if ssl_object.session is not None:
+            self.ssl_context(host).session = ssl_object.session
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики TLS рукопожатий."""
+        return {'handshakes': self._handshakes, 'resumed': self._resumed}
+
+
+host_connector: HostConnector = HostConnector()
+
+
+class GreetingProtocol(aioimaplib.IMAP4ClientProtocol):
+    """Протокол IMAP без команды CAPABILITY после приветствия.
+
+    Возможности до входа берутся из приветствия, если сервер их
+    прислал, возможности после входа - из CapabilityCache."""
+
+    @aioimaplib.change_state
+    async def welcome(self, command: bytes) -> None:
+        if b'PREAUTH' in command:
+            self.state = aioimaplib.AUTH
+        elif b'OK' in command:
+            self.state = aioimaplib.NONAUTH
+        else:
+            raise aioimaplib.Error(command.decode())
+        match = GREETING_CAPABILITY.search(command)
+        if match:
+            self.capabilities = set(
+                match.group('capabilities').decode().split(),
+            )
+
+
+class CapabilityCache:
+    """Кэш возможностей почтовых серверов после входа.
+
+    Возможности сервера запрашиваются при первом подключении
+    и хранятся в redis CAPABILITIES_TTL секунд, последующие
+    подключения к серверу не запрашивают их заново.
+    """
+
+    def __init__(self):
+        self.redis = redis_client
+
+    async def get(self, host: str) -> set[str] | None:
+        """Получить сохраненные возможности сервера."""
+        capabilities = await self.redis.get(
+            settings.HOST_CAPABILITIES_KEY.format(host=host),
+        )
+        return set(capabilities) if capabilities else None
+
+    async def apply(self, imap_client: aioimaplib.IMAP4, host: str) -> None:
+        """Установить клиенту возможности сервера из кэша или запросить
+        их у сервера."""
+        protocol = imap_client.protocol
+        capabilities = await self.get(host)
+        if capabilities is not None:
+            protocol.capabilities = capabilities
+            return None
+        await asyncio.wait_for(protocol.capability(), imap_client.timeout)
+        await self.redis.set(
+            settings.HOST_CAPABILITIES_KEY.format(host=host),
+            sorted(protocol.capabilities),
+            settings.CAPABILITIES_TTL,
+        )
+
+    async def forget(self, host: str) -> None:
+        """Удалить сохраненные возможности сервера."""
+        await self.redis.delete(
+            settings.HOST_CAPABILITIES_KEY.format(host=host),
+        )
+
+
+capability_cache: CapabilityCache = CapabilityCache()
+
+
+class StreamingFetchCommand(aioimaplib.FetchCommand):
+    """Команда FETCH, разбирающая литералы по мере их получения.
+
+    Литерал не накапливается целиком: каждый пришедший кусок сразу
+    передается разборщику, созданному parser_factory, а в строки
+    ответа вместо байтов литерала попадает результат разбора.
+    """
+
+    def __init__(
+        self,
+        tag: str,
+        *args: str,
+        parser_factory: Callable[[], BytesFeedParser],
+        **kwargs,
+    ):
+        super().__init__(tag, *args, **kwargs)
+        self._parser_factory = parser_factory
+        self._parser: BytesFeedParser | None = None
+        self._received = 0
+
+    def begin_literal_data(
+        self,
+        expected_size: int,
+        literal_data: bytes = b'',
+    ) -> bytes:
+        self._parser = self._parser_factory()
+        self._received = 0
+        return super().begin_literal_data(expected_size, literal_data)
+
+    def wait_literal_data(self) -> bool:
+        if self._expected_size == 0:
+            return False
+        return self._received != self._expected_size
+
+    def append_literal_data(self, data: bytes) -> bytes:
+        size = self._expected_size - self._received
+        self._parser.feed(bytes(data[:size]))
+        self._received += len(data[:size])
+        if not self.wait_literal_data():
+            self.append_to_resp(self._parser.close())
+            self._parser = None
+            self._received = 0
+            self._end_literal_data()
+        self._reset_timer()
+        return data[size:]
+
+
+class IMAP4SSLClient(aioimaplib.IMAP4):
+    """IMAP клиент поверх SSL с общим контекстом и кэшем адресов
+    сервера."""
+
+    def __init__(
+        self,
+        host: str,
+        port: int = aioimaplib.IMAP4_SSL_PORT,
+        timeout: float = aioimaplib.IMAP4.TIMEOUT_SECONDS,
+        conn_lost_cb: Callable[[Exception | None], None] | None = None,
+    ):
+        super().__init__(
+            host=host,
+            port=port,
+            timeout=timeout,
+            conn_lost_cb=conn_lost_cb,
+        )
+
+    def create_client(
+        self,
+        host: str,
+        port: int,
+        loop: asyncio.AbstractEventLoop | None,
+        conn_lost_cb: Callable[[Exception | None], None] | None = None,
+        ssl_context: ssl.SSLContext | None = None,
+    ) -> None:
+        local_loop = loop or asyncio.get_running_loop()
+        self.protocol = GreetingProtocol(local_loop, conn_lost_cb)
+        self._client_task = local_loop.create_task(
+            self._connect(local_loop, host, port),
+        )
+
+    async def _connect(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        host: str,
+        port: int,
+    ) -> None:
+        """Установить соединение с сервером.
+
+        Адреса сервера перебираются по очереди, пока подключение
+        к одному из них не удастся."""
+        try:
+            addresses = await host_connector.resolve(host, port)
+        except OSError as error:
+            logger.warning(f'HOST {host}. Resolve failed: {error!r}')
+            raise
+        last_error = OSError(f'No addresses for {host}')
+        for address in addresses:
+            try:
+                await loop.create_connection(
+                    lambda: self.protocol,
+                    address,
+                    port,
+                    ssl=host_connector.ssl_context(host),
+                    server_hostname=host,
+                )
+                return None
+            except OSError as error:
+                logger.warning(
+                    f'HOST {host}. Connect to {address} failed: {error!r}',
+                )
+                last_error = error
+        host_connector.forget_address(host)
+        raise last_error
+
+    async def wait_hello_from_server(self) -> None:
+        await super().wait_hello_from_server()
+        host_connector.save_session(self.host, self.protocol.transport)
+
+    async def uid_fetch_parsed(
+        self,
+        message_set: str,
+        message_parts: str,
+        parser_factory: Callable[[], BytesFeedParser],
+    ) -> aioimaplib.Response:
+        """Выполнить UID FETCH, разбирая литералы ответа потоково."""
+        if self.protocol.state != aioimaplib.SELECTED:
+            raise aioimaplib.Abort(
+                'command UID illegal in state %s' % self.protocol.state,
+            )
+        return await self.protocol.execute(
+            StreamingFetchCommand(
+                self.protocol.new_tag(),
+                message_set,
+                message_parts,
+                parser_factory=parser_factory,
+                prefix='UID',
+                loop=self.protocol.loop,
+                timeout=self.timeout,
+            ),
+        )
+
+
+class DeflateTransport(asyncio.Transport):
+    """Транспорт, сжимающий исходящие данные (RFC 4978)."""
+
+    def __init__(self, transport: asyncio.Transport):
+        super().__init__()
+        self._transport = transport
+        self._compressor = zlib.compressobj(wbits=-15)
+
+    def write(self, data: bytes) -> None:
+        compressed = self._compressor.compress(data)
+        self._transport.write(
+            compressed + self._compressor.flush(zlib.Z_SYNC_FLUSH),
+        )
+
+    def close(self) -> None:
+        self._transport.close()
+
+    def is_closing(self) -> bool:
+        return self._transport.is_closing()
+
+    def abort(self) -> None:
+        self._transport.abort()
+
+    def get_extra_info(self, name: str, default=None):
+        return self._transport.get_extra_info(name, default)
+
+
+class DeflateProtocol(asyncio.Protocol):
+    """Протокол, распаковывающий входящие данные перед передачей
+    протоколу IMAP."""
+
+    def __init__(self, protocol: asyncio.Protocol):
+        self._protocol = protocol
+        self._decompressor = zlib.decompressobj(wbits=-15)
+
+    def data_received(self, data: bytes) -> None:
+        self._protocol.data_received(self._decompressor.decompress(data))
+
+    def eof_received(self) -> bool | None:
+        return self._protocol.eof_received()
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        self._protocol.connection_lost(exc)
+
+
+async def enable_compression(imap_client: aioimaplib.IMAP4) -> bool:
+    """Включить сжатие соединения, если сервер поддерживает
+    COMPRESS=DEFLATE.
+
+    Команда допустима только до выбора папки."""
+    protocol = imap_client.protocol
+    if 'COMPRESS=DEFLATE' not in protocol.capabilities:
+        return False
+    response = await asyncio.wait_for(
+        protocol.execute(aioimaplib.Command(
+            'COMPRESS',
+            protocol.new_tag(),
+            'DEFLATE',
+            loop=protocol.loop,
+        )),
+        imap_client.timeout,
+    )
+    if response.result != 'OK':
+        return False
+    transport = protocol.transport
+    transport.set_protocol(DeflateProtocol(protocol))
+    protocol.transport = DeflateTransport(transport)
+    return True
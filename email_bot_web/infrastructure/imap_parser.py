@@ -0,0 +1,448 @@
+import base64
+import html
+import quopri
+import re
+from email.errors import HeaderParseError
+from email.header import decode_header
+from email.message import Message
+from email.feedparser import BufferedSubFile, FeedParser, NeedMoreData
+from email.parser import BytesFeedParser
+from email.utils import decode_rfc2231
+from typing import Any, Iterable
+from urllib.parse import unquote
+
+from aioimaplib import quoted
+
+FETCH_MESSAGE_START = re.compile(rb'^(?P<number>\d+) FETCH ')
+LITERAL_END = re.compile(rb'\{(?P<size>\d+)\}$')
+SECTION_FIELDS = re.compile(rb' ?\(.*\)')
+SECTION_ORIGIN = re.compile(rb'<\d+>$')
+ATOM_DELIMITERS = b' ()"{'
+TEXT_CONTENT_TYPES = ('text/plain', 'text/html')
+ALTERNATIVE_RANKS = {'text/plain': 1, 'text/html': 2}
+HTML_HIDDEN = re.compile(
+    r'<(script|style|head)\b.*?</\1\s*>',
+    re.IGNORECASE | re.DOTALL,
+)
+HTML_TAG = re.compile(r'<[^>]*>')
+
+
+def parse_search_response(lines: list[bytes]) -> list[int]:
+    """Получить номера писем из ответа на команду SEARCH."""
+    return [
+        int(number)
+        for line in lines[:-1]
+        for number in line.split()
+        if number.isdigit()
+    ]
+
+
+def build_filter_search(keys: list[tuple[str, str]]) -> str | None:
+    """Собрать критерий SEARCH, выбирающий письма, подходящие под любой
+    из ключей поиска, например ('FROM', 'user@company.com').
+
+    Поиск на сервере ищет подстроку, поэтому у шаблонов отправителей
+    отбрасывается ведущий *. Строки в кавычках не могут содержать
+    не ASCII символы, а литералы aioimaplib в поиске не передает,
+    поэтому для таких значений, пустых значений или * внутри шаблона
+    критерий не строится и письма отбираются по фильтрам на клиенте."""
+    keys = [
+        (key, value.lstrip('*') if key == 'FROM' else value)
+        for key, value in keys
+    ]
+    if not keys or not all(
+        value and value.isascii() and '*' not in value
+        for _, value in keys
+    ):
+        return None
+    criteria = ' '.join(f'{key} {quoted(value)}' for key, value in keys)
+    return 'OR ' * (len(keys) - 1) + criteria
+
+
+def parse_imap_data(data: bytes, literals: Iterable[bytes]) -> list[Any]:
+    """Разобрать данные ответа IMAP во вложенные списки.
+
+    Атомы и строки возвращаются как bytes, NIL - как None,
+    литералы подставляются из literals по порядку."""
+    literals = iter(literals)
+    stack: list[list[Any]] = [[]]
+    index = 0
+    while index < len(data):
+        char = data[index:index + 1]
+        if char in b' \r\n':
+            index += 1
+        elif char == b'(':
+            stack.append([])
+            index += 1
+        elif char == b')':
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+            index += 1
+        elif char == b'"':
+            value = bytearray()
+            index += 1
+            while index < len(data) and data[index:index + 1] != b'"':
+                if data[index:index + 1] == b'\\':
+                    index += 1
+                value += data[index:index + 1]
+                index += 1
+            stack[-1].append(bytes(value))
+            index += 1
+        elif char == b'{':
+            index = data.index(b'}', index) + 1
+            stack[-1].append(next(literals, b''))
+        else:
+            start = index
+            while index < len(data) and data[index] not in ATOM_DELIMITERS:
+                if data[index:index + 1] == b'[':
+                    index = data.find(b']', index)
+                    if index == -1:
+                        index = len(data)
+                        break
+                index += 1
+            atom = data[start:index]
+            stack[-1].append(None if atom.upper() == b'NIL' else atom)
+    while len(stack) > 1:
+        item = stack.pop()
+        stack[-1].append(item)
+    return stack[0]
+
+
+def normalize_fetch_key(key: bytes) -> str:
+    """Привести имя атрибута FETCH к виду без списка полей и смещения,
+    например BODY[HEADER.FIELDS (FROM)]<0> -> BODY[HEADER.FIELDS]."""
+    key = SECTION_ORIGIN.sub(b'', key.upper())
+    return SECTION_FIELDS.sub(b'', key).decode()
+
+
+def split_fetch_messages(
+    lines: list[bytes],
+) -> list[tuple[bytes, list[bytes]]]:
+    """Сгруппировать строки ответа FETCH по письмам.
+
+    Для каждого письма возвращает текст ответа без литералов
+    и список литералов в порядке следования."""
+    messages: list[tuple[bytearray, list[bytes]]] = []
+    expect_literal = False
+    for line in lines:
+        if expect_literal:
+            if messages:
+                messages[-1][1].append(line)
+            expect_literal = False
+            continue
+        if FETCH_MESSAGE_START.match(line):
+            messages.append((bytearray(line), []))
+        elif messages:
+            messages[-1][0].extend(b' ' + line)
+        expect_literal = bool(LITERAL_END.search(line))
+    return [(bytes(text), literals) for text, literals in messages]
+
+
+def parse_fetch_response(lines: list[bytes]) -> dict[int, dict[str, Any]]:
+    """Разобрать ответ на UID FETCH.
+
+    Возвращает атрибуты каждого письма ответа по его UID.
+    Непрошенные ответы FETCH без UID пропускаются."""
+    messages = {}
+    for text, literals in split_fetch_messages(lines):
+        match = FETCH_MESSAGE_START.match(text)
+        data = parse_imap_data(text[match.end():], literals)
+        if not data or not isinstance(data[0], list):
+            continue
+        items = data[0]
+        attributes = {
+            normalize_fetch_key(key): value
+            for key, value in zip(items[::2], items[1::2])
+            if isinstance(key, bytes)
+        }
+        uid = attributes.get('UID')
+        if uid is None or not uid.isdigit():
+            continue
+        attributes['UID'] = int(uid)
+        messages[int(uid)] = attributes
+    return messages
+
+
+def decode_header_value(value: str) -> str:
+    """Декодировать значение заголовка в кодировке RFC 2047.
+
+    Неизвестные кодировки и ошибочные байты заменяются, а не приводят
+    к исключению."""
+    try:
+        parts = decode_header(value)
+    except HeaderParseError:
+        return value
+    decoded_value = ''
+    for part, encoding in parts:
+        if isinstance(part, bytes):
+            decoded_value += _decode_text(part, encoding or 'utf-8')
+        else:
+            decoded_value += str(part)
+    return decoded_value
+
+
+def _to_str(value: Any) -> str:
+    """Привести атом или строку ответа IMAP к str."""
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return ''
+
+
+def _params_to_dict(params: Any) -> dict[str, str]:
+    """Привести список параметров BODYSTRUCTURE к словарю."""
+    if not isinstance(params, list):
+        return {}
+    return {
+        _to_str(key).lower(): _to_str(value)
+        for key, value in zip(params[::2], params[1::2])
+    }
+
+
+def _part_filename(params: dict[str, str]) -> str | None:
+    """Получить имя файла из параметров части письма."""
+    for name in ('filename', 'name'):
+        if params.get(f'{name}*'):
+            charset, _, value = decode_rfc2231(params[f'{name}*'])
+            try:
+                return unquote(value, encoding=charset or 'utf-8')
+            except LookupError:
+                return unquote(value)
+        if params.get(name):
+            return decode_header_value(params[name])
+    return None
+
+
+def preferred_alternative(content_types: list[str]) -> int | None:
+    """Выбрать часть multipart/alternative для показа.
+
+    HTML и вложенные multipart предпочитаются простому тексту,
+    из равных выбирается последняя часть как самая полная (RFC 2046).
+    Возвращает индекс части или None, если текстовых частей нет."""
+    preferred, preferred_rank = None, 0
+    for index, content_type in enumerate(content_types):
+        if content_type.startswith('multipart/'):
+            rank = ALTERNATIVE_RANKS['text/html']
+        else:
+            rank = ALTERNATIVE_RANKS.get(content_type, 0)
+        if rank and rank >= preferred_rank:
+            preferred, preferred_rank = index, rank
+    return preferred
+
+
+def _structure_type(part: list[Any]) -> str:
+    """Получить тип содержимого части BODYSTRUCTURE."""
+    if part and isinstance(part[0], list):
+        return 'multipart/'
+    if len(part) < 2:
+        return ''
+    return f'{_to_str(part[0])}/{_to_str(part[1])}'.lower()
+
+
+def _walk_bodystructure(
+    part: list[Any],
+    section: str,
+    result: dict[str, list[Any]],
+) -> None:
+    """Обойти часть BODYSTRUCTURE и разложить ее по результату.
+
+    Из частей multipart/alternative обходится только выбранная
+    для показа."""
+    if part and isinstance(part[0], list):
+        children = []
+        for child in part:
+            if not isinstance(child, list):
+                break
+            children.append(child)
+        indexes = range(len(children))
+        subtype = part[len(children)] if len(part) > len(children) else None
+        if _to_str(subtype).lower() == 'alternative':
+            preferred = preferred_alternative(
+                [_structure_type(child) for child in children],
+            )
+            indexes = [] if preferred is None else [preferred]
+        for index in indexes:
+            number = index + 1
+            child_section = f'{section}.{number}' if section else str(number)
+            _walk_bodystructure(children[index], child_section, result)
+        return None
+    if len(part) < 7:
+        return None
+    content_type = f'{_to_str(part[0])}/{_to_str(part[1])}'.lower()
+    params = _params_to_dict(part[2])
+    if content_type in TEXT_CONTENT_TYPES:
+        result['text'].append({
+            'section': section or '1',
+            'type': content_type,
+            'charset': params.get('charset') or 'utf-8',
+            'encoding': _to_str(part[5]).lower(),
+            'size': int(part[6]) if _to_str(part[6]).isdigit() else 0,
+        })
+        return None
+    if content_type.startswith('text/'):
+        disposition_index = 9
+    elif content_type == 'message/rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = None
+    if len(part) > disposition_index:
+        disposition = part[disposition_index]
+    if isinstance(disposition, list) and len(disposition) > 1:
+        params = {**params, **_params_to_dict(disposition[1])}
+    filename = _part_filename(params)
+    if filename:
+        result['attachments'].append(filename)
+
+
+def parse_bodystructure(structure: Any) -> dict[str, list[Any]] | None:
+    """Получить из BODYSTRUCTURE текстовые части письма и имена вложений.
+
+    Текстовая часть описывается номером секции, кодировкой символов,
+    кодированием передачи и размером."""
+    if not isinstance(structure, list):
+        return None
+    result: dict[str, list[Any]] = {'text': [], 'attachments': []}
+    _walk_bodystructure(structure, '', result)
+    return result
+
+
+def _decode_text(data: bytes, charset: str) -> str:
+    """Декодировать текст в кодировке charset, заменяя ошибки."""
+    try:
+        return data.decode(charset, errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+
+def decode_body_section(data: bytes, section: dict[str, Any]) -> str:
+    """Декодировать содержимое текстовой секции письма.
+
+    Секция может быть обрезана частичной выборкой, поэтому неполные
+    последовательности отбрасываются или заменяются."""
+    if section['encoding'] == 'base64':
+        data = b''.join(data.split())
+        data = base64.b64decode(data[:len(data) - len(data) % 4])
+    elif section['encoding'] == 'quoted-printable':
+        data = quopri.decodestring(data)
+    return _decode_text(data, section['charset'])
+
+
+def keeps_payload(message: Message | None) -> bool:
+    """Нужно ли хранить содержимое части письма.
+
+    Хранятся текстовые части и составные части, содержащие
+    другие части."""
+    if message is None:
+        return True
+    if message.get_content_maintype() in ('multipart', 'message'):
+        return True
+    return message.get_content_type() in TEXT_CONTENT_TYPES
+
+
+class TextOnlyMessage(Message):
+    """Письмо, хранящее содержимое только текстовых частей.
+
+    Содержимое остальных частей отбрасывается, заголовки и имена
+    вложений сохраняются."""
+
+    def set_payload(self, payload: Any, charset: Any = None) -> None:
+        if not keeps_payload(self):
+            payload = ''
+        super().set_payload(payload, charset)
+
+
+class TextOnlySubFile(BufferedSubFile):
+    """Буфер строк разборщика, пропускающий строки содержимого
+    нетекстовых частей.
+
+    Строки вложений не накапливаются в разборщике до конца части,
+    границы частей по-прежнему распознаются."""
+
+    def __init__(self, parser: FeedParser):
+        super().__init__()
+        self._parser = parser
+
+    def readline(self) -> Any:
+        while True:
+            line = super().readline()
+            if line == '' or line is NeedMoreData:
+                return line
+            if keeps_payload(self._parser._cur):
+                return line
+
+
+class TextOnlyFeedParser(BytesFeedParser):
+    """Потоковый разборщик письма, отбрасывающий содержимое
+    нетекстовых частей при разборе."""
+
+    def __init__(self):
+        super().__init__(_factory=TextOnlyMessage)
+        self._input = TextOnlySubFile(self)
+
+
+def message_stream_parser() -> TextOnlyFeedParser:
+    """Создать потоковый разборщик письма, отбрасывающий
+    нетекстовые части."""
+    return TextOnlyFeedParser()
+
+
+def _collect_content(part: Message, content: dict[str, list[str]]) -> None:
+    """Добавить текст или название вложения части письма в content."""
+    if part.is_multipart():
+        children = part.get_payload()
+        if part.get_content_type() == 'multipart/alternative':
+            preferred = preferred_alternative(
+                [child.get_content_type() for child in children],
+            )
+            children = [] if preferred is None else [children[preferred]]
+        for child in children:
+            _collect_content(child, content)
+        return None
+    content_type = part.get_content_type()
+    if content_type in TEXT_CONTENT_TYPES:
+        content['Text'].append(_decode_text(
+            part.get_payload(decode=True) or b'',
+            part.get_content_charset() or 'utf-8',
+        ))
+        content['Types'].append(content_type)
+        return None
+    filename = part.get_filename()
+    if filename:
+        content['Attachments'].append(decode_header_value(filename))
+
+
+def extract_message_content(message: Message) -> dict[str, list[str]]:
+    """Извлечь из письма за один обход текст, названия вложений
+    и типы текстовых частей.
+
+    Из вариантов multipart/alternative берется один, предпочтительно
+    HTML."""
+    content: dict[str, list[str]] = {
+        'Text': [],
+        'Attachments': [],
+        'Types': [],
+    }
+    _collect_content(message, content)
+    return content
+
+
+def content_plain_text(content: dict[str, list[str]]) -> str:
+    """Получить текст письма без разметки HTML."""
+    parts = []
+    for text, content_type in zip(content['Text'], content['Types']):
+        if content_type == 'text/html':
+            text = html.unescape(HTML_TAG.sub(' ', HTML_HIDDEN.sub(' ', text)))
+        parts.append(text)
+    return '\n'.join(parts)
+
+
+def decode_body_sections(
+    data: list[bytes],
+    sections: list[dict[str, Any]],
+) -> list[str]:
+    """Декодировать содержимое текстовых секций письма."""
+    return [
+        decode_body_section(section_data, section)
+        for section_data, section in zip(data, sections)
+    ]
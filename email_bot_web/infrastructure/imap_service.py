@@ -1,17 +1,21 @@
 import asyncio
-import email
+import hashlib
+import hmac
 import logging
 import re
+import time
 from asyncio import wait_for
-from email.header import decode_header
+from contextlib import suppress
 from email.message import Message
 from email.parser import BytesHeaderParser
 from email.utils import parseaddr
-from typing import Collection
+from functools import partial
+from typing import Any, Collection
 
 import aioimaplib
 from django.conf import settings
 
+from email_service.models import FilterType
 from infrastructure.error_messages import (
     IMAP_AUTHENTICATION_FAILED,
     IMAP_CONNECTION_ERROR,
@@ -22,6 +26,29 @@ from infrastructure.exceptions import (
     ImapConnectionError,
     ServerUnavailable,
 )
+from infrastructure.filter_index import filter_indexes
+from infrastructure.imap_connection import (
+    IMAP4SSLClient,
+    capability_cache,
+    enable_compression,
+    host_breaker,
+    host_limiter,
+)
+from infrastructure.imap_parser import (
+    build_filter_search,
+    content_plain_text,
+    decode_body_sections,
+    decode_header_value,
+    extract_message_content,
+    message_stream_parser,
+    parse_bodystructure,
+    parse_fetch_response,
+    parse_search_response,
+)
+from infrastructure.keepalive import enable_tcp_keepalive, idle_timeout_tuner
+from infrastructure.parse_pool import parse_pool
+from infrastructure.polling import poll_scheduler
+from infrastructure.reconnect import reconnect_scheduler
 from infrastructure.redis_service import redis_client
 from infrastructure.repository import Repository
 from infrastructure.tasks import (
@@ -33,90 +60,133 @@ from infrastructure.template import HTML_FORMAT
 ID_HEADER_SET = {'Content-Type', 'From', 'To', 'Cc', 'Bcc', 'Date', 'Subject',
                  'Message-ID', 'In-Reply-To', 'References'}
 
-FETCH_MESSAGE_DATA_UID = re.compile(rb'.*UID (?P<uid>\d+).*')
+SELECT_UID_DATA = re.compile(
+    rb'(?P<name>UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (?P<value>\d+)',
+)
+SEARCH_KEYS = {
+    FilterType.SENDER: 'FROM',
+    FilterType.SUBJECT: 'SUBJECT',
+    FilterType.BODY: 'BODY',
+}
+RECONNECT_ERRORS = (
+    asyncio.TimeoutError,
+    OSError,
+    aioimaplib.AioImapException,
+    ImapAuthenticationFailed,
+    ImapConnectionError,
+)
 
 logger = logging.getLogger('imap')
 repo = Repository()
 
 
+def sender_label(sender_email: str, name: str) -> str:
+    """Подпись отправителя письма: адрес и имя из фильтра."""
+    return f'{sender_email} {name}' if name else sender_email
+
+
 class EmailMessageService:
     """Сервис для работы с новыми письмами."""
 
-    async def extract_text_parts(self, message: Message) -> list[str]:
-        """Извлечь текстовые части из письма."""
-        text_parts = []
-        if message.is_multipart():
-            for part in message.get_payload():
-                if part.get_content_type() in ('text/plain', 'text/html'):
-                    text_parts.append(part.get_payload(decode=True).decode())
-                elif part.is_multipart():
-                    text_parts.extend(await self.extract_text_parts(part))
-        else:
-            text_parts.append(message.get_payload(decode=True).decode())
-        return text_parts
-
-    async def extract_attach_names(self, message: Message) -> list[str]:
-        """Извлечь названия приложенных файлов."""
-        attach_names = []
-        for part in message.walk():
-            if part.get_content_type() not in ('text/plain', 'text/html'):
-                attachment_filename = part.get_filename()
-                if attachment_filename:
-                    decoded_parts = decode_header(attachment_filename)
-                    decoded_filename = ''
-                    for part, encoding in decoded_parts:
-                        if isinstance(part, bytes):
-                            decoded_filename += str(part.decode(
-                                encoding or 'utf-8',
-                            ))
-                        else:
-                            decoded_filename += str(part)
-                    attach_names.append(decoded_filename)
-        return attach_names
+    async def extract_content(self, message: Message) -> dict[str, list[str]]:
+        """Извлечь текст и названия вложений из письма."""
+        return extract_message_content(message)
 
-    async def process_new_message(
+    async def match_sender(
         self,
-        message: Message,
+        headers: Message,
         box_id: int,
         telegram_id: int,
-        username: str,
-    ) -> None:
-        """Обработать новое письмо."""
-        logger.info(f'BOX {box_id}. Processing new message.')
-        sender = message['From']
-        sender_email = parseaddr(sender)[1]
+    ) -> str | None:
+        """Проверить заголовки письма по фильтрам отправителей
+        и ключевым словам темы ящика.
 
-        filters = await repo.filter.get_box_filters_value_list(
+        Возвращает подпись отправителя из фильтра или None, если
+        письмо не подходит под фильтры."""
+        sender_email = parseaddr(headers['From'])[1]
+        index = await filter_indexes.get(
             box_id=box_id,
             telegram_id=telegram_id,
         )
-        for filter in filters:
-            if sender_email == filter[0]:
-                sender_email = f'{filter[0]} {filter[1]}'
-                break
-        else:
+        name = index.match(sender_email)
+        if name is not None:
+            return sender_label(sender_email, name)
+        if index.subject_keywords:
+            keyword = index.subject_keywords.search(
+                decode_header_value(headers['Subject'] or ''),
+            )
+            if keyword:
+                return sender_label(sender_email, keyword)
+        if not index.body_keywords:
             logger.info(f'BOX {box_id}. New message sender not in filters.')
-            return None
+        return None
 
-        subject = message['Subject']
-        if subject:
-            decoded_subject = decode_header(subject)[0][0]
-            if isinstance(decoded_subject, bytes):
-                decoded_subject = decoded_subject.decode()
-        else:
-            decoded_subject = ''
+    async def has_body_keywords(self, box_id: int, telegram_id: int) -> bool:
+        """Проверить, есть ли у ящика фильтры по тексту письма."""
+        index = await filter_indexes.get(
+            box_id=box_id,
+            telegram_id=telegram_id,
+        )
+        return bool(index.body_keywords)
+
+    async def match_body(
+        self,
+        headers: Message,
+        content: dict[str, list[str]],
+        box_id: int,
+        telegram_id: int,
+    ) -> str | None:
+        """Проверить текст письма по ключевым словам фильтров ящика.
+
+        Возвращает подпись отправителя или None, если письмо
+        не подходит под фильтры."""
+        index = await filter_indexes.get(
+            box_id=box_id,
+            telegram_id=telegram_id,
+        )
+        keyword = index.body_keywords.search(content_plain_text(content))
+        if keyword:
+            return sender_label(parseaddr(headers['From'])[1], keyword)
+        logger.info(f'BOX {box_id}. New message not in filters.')
+        return None
 
-        logger.info(f'BOX {box_id}. Extracting text.')
-        raw_text = await self.extract_text_parts(message)
-        logger.info(f'BOX {box_id}. Extracting attachments.')
-        attaches = await self.extract_attach_names(message)
+    @redis_client.cache_result(key_format=settings.FILTERS_SEARCH_KEY)
+    async def get_sender_search(
+        self,
+        box_id: int,
+        telegram_id: int,
+    ) -> str | None:
+        """Получить критерий SEARCH по фильтрам ящика.
+
+        Для ящиков с большим числом фильтров критерий не строится."""
+        filters = await repo.filter.get_box_filters_value_list(
+            box_id=box_id,
+            telegram_id=telegram_id,
+        )
+        if len(filters) > settings.SERVER_SEARCH_MAX_FILTERS:
+            return None
+        return build_filter_search([
+            (SEARCH_KEYS[filter_type], value)
+            for value, _, filter_type in filters
+        ])
 
+    async def process_new_message(
+        self,
+        headers: Message,
+        content: dict[str, list[str]],
+        sender: str,
+        box_id: int,
+        telegram_id: int,
+        username: str,
+    ) -> None:
+        """Обработать новое письмо отправителя из фильтров."""
+        logger.info(f'BOX {box_id}. Processing new message.')
         message_data = {
-            'From': sender_email,
+            'From': sender,
             'To': username,
-            'Subject': decoded_subject,
-            'Text': raw_text,
-            'Attachments': attaches,
+            'Subject': decode_header_value(headers['Subject'] or ''),
+            'Text': content['Text'],
+            'Attachments': content['Attachments'],
         }
         logger.info(f'BOX {box_id}. Message prepare.')
 
@@ -152,6 +222,8 @@ class IMAPClient:
         password: str,
         telegram_id: int,
         box_id: int,
+        poll_interval: int,
+        use_compression: bool,
     ):
         self.host = host
         self.port = port
@@ -159,9 +231,13 @@ class IMAPClient:
         self.password = password
         self.telegram_id = telegram_id
         self.box_id = box_id
+        self.poll_interval = poll_interval
+        self.use_compression = use_compression
         self.current_max_uid = 1
+        self.uidvalidity: int | None = None
+        self.highest_modseq: int | None = None
+        self.login_attempted = asyncio.Event()
         self.redis = redis_client
-        self.restart_loop = False
         self.mail_processor = EmailMessageService()
 
     @classmethod
@@ -172,21 +248,51 @@ class IMAPClient:
         username: str,
         password: str,
     ) -> None:
-        """Проверка соединения с почтовыми ящиками."""
-        try:
-            check_client = aioimaplib.IMAP4_SSL(
+        """Проверка соединения с почтовыми ящиками.
+
+        После проверки выполняется выход из ящика, удачный результат
+        запоминается на VERIFIED_CONNECTION_TTL секунд."""
+        verified_key = settings.VERIFIED_CONNECTION_KEY.format(
+            digest=hmac.new(
+                settings.SECRET_KEY.encode(),
+                f'{host}:{port}:{username}:{password}'.encode(),
+                hashlib.sha256,
+            ).hexdigest(),
+        )
+        if await redis_client.get(verified_key):
+            return None
+        async with (
+            host_breaker.attempt(host, wait=False),
+            host_limiter.acquire(host),
+        ):
+            check_client = IMAP4SSLClient(
                 host=host,
                 port=port,
                 timeout=20,
             )
-            await check_client.wait_hello_from_server()
-        except (ConnectionRefusedError, asyncio.exceptions.TimeoutError):
-            logger.error(f'USERNAME {username} HOST {host} connection error.')
-            raise ServerUnavailable(SERVER_UNAVAILABLE)
-        response = await check_client.login(
-            user=username,
-            password=password,
-        )
+            try:
+                try:
+                    await check_client.wait_hello_from_server()
+                except (
+                    ConnectionRefusedError,
+                    asyncio.exceptions.TimeoutError,
+                ):
+                    logger.error(
+                        f'USERNAME {username} HOST {host} connection error.',
+                    )
+                    raise ServerUnavailable(SERVER_UNAVAILABLE)
+                response = await check_client.login(
+                    user=username,
+                    password=password,
+                )
+                if response.result == 'OK':
+                    with suppress(
+                        asyncio.TimeoutError,
+                        aioimaplib.AioImapException,
+                    ):
+                        await check_client.logout()
+            finally:
+                cls.close_connection(check_client)
         if response.result != 'OK':
             for line in response.lines:
                 if b'ALERT' in line:
@@ -195,56 +301,354 @@ class IMAPClient:
                 if b'AUTHENTICATIONFAILED' in line or response.result == 'NO':
                     logger.error(f'USERNAME {username} authentication failed.')
                     raise ImapAuthenticationFailed(IMAP_AUTHENTICATION_FAILED)
+            return None
+        await redis_client.set(
+            verified_key,
+            settings.ACTIVE_VALUE,
+            settings.VERIFIED_CONNECTION_TTL,
+        )
+
+    async def load_uid_state(self) -> dict[str, int] | None:
+        """Получить сохраненные UIDVALIDITY, последний обработанный UID
+        и HIGHESTMODSEQ."""
+        return await self.redis.get(settings.BOX_UID_STATE_KEY.format(
+            telegram_id=self.telegram_id,
+            box_id=self.box_id,
+        ))
+
+    async def save_uid_state(self) -> None:
+        """Сохранить UIDVALIDITY, последний обработанный UID
+        и HIGHESTMODSEQ."""
+        await self.redis.set(
+            settings.BOX_UID_STATE_KEY.format(
+                telegram_id=self.telegram_id,
+                box_id=self.box_id,
+            ),
+            {
+                'uidvalidity': self.uidvalidity,
+                'uid': self.current_max_uid,
+                'modseq': self.highest_modseq,
+            },
+        )
+
+    async def restore_uid_state(self, uidvalidity: int, uidnext: int) -> bool:
+        """Восстановить водяной знак UID после подключения.
+
+        Возвращает True, если с прошлого подключения могли прийти письма,
+        которые нужно догрузить. Сохраненный HIGHESTMODSEQ остается
+        в highest_modseq до окончания догрузки."""
+        state = await self.load_uid_state()
+        self.uidvalidity = uidvalidity
+        if state and state['uidvalidity'] == uidvalidity:
+            self.current_max_uid = state['uid']
+            self.highest_modseq = state.get('modseq')
+            return self.current_max_uid < uidnext - 1
+        logger.info(f'BOX {self.box_id}. UID state reset.')
+        self.highest_modseq = None
+        self.current_max_uid = uidnext - 1
+        await self.save_uid_state()
+        return False
+
+    async def search_new_uids(
+        self,
+        imap_client: IMAP4SSLClient,
+        max_uid: int,
+        criteria: str,
+    ) -> list[int] | None:
+        """Найти на сервере письма с UID больше max_uid, подходящие под
+        критерий, и последнее письмо ящика.
+
+        Поиск FROM на сервере ищет подстроку, поэтому найденные письма
+        все равно проверяются по фильтрам. Последнее письмо нужно,
+        чтобы сдвинуть водяной знак. Возвращает None, если сервер
+        не выполнил поиск."""
+        response = await imap_client.uid_search(
+            'UID', '%d:*' % (max_uid + 1),
+            'OR', '(%s)' % criteria, 'UID', '*',
+            charset=None,
+        )
+        if response.result != 'OK':
+            logger.warning(f'BOX {self.box_id}. Server search failed.')
+            return None
+        return sorted(
+            uid for uid in parse_search_response(response.lines)
+            if uid > max_uid
+        )
 
     async def fetch_messages_headers(
         self,
-        imap_client: aioimaplib.IMAP4_SSL,
+        imap_client: IMAP4SSLClient,
         max_uid: int,
-        username: str,
-        return_message: bool,
-    ) -> int:
-        """Получить заголовки писем,
-        при новом письме - отправить на обработку."""
+        uids: list[int] | None = None,
+        changed_since: int | None = None,
+    ) -> dict[int, dict[str, Any]]:
+        """Получить заголовки, размер и структуру писем uids или всех
+        писем с UID больше max_uid одной командой FETCH.
+
+        С changed_since выбираются только письма, измененные после
+        этого MODSEQ (CONDSTORE)."""
         logger.info(f'BOX {self.box_id}. Fetching start.')
+        if uids:
+            message_set = ','.join(str(uid) for uid in uids)
+        else:
+            message_set = '%d:*' % (max_uid + 1)
+        modifiers = ''
+        if changed_since is not None:
+            modifiers = ' (CHANGEDSINCE %d)' % changed_since
         response = await imap_client.uid(
-            'fetch', '%d:*' % (max_uid),
-            '(UID FLAGS BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(
-                ID_HEADER_SET,
+            'fetch', message_set,
+            '(UID RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (%s)])%s'
+            % (' '.join(ID_HEADER_SET), modifiers),
+        )
+        if response.result != 'OK':
+            return {}
+        logger.info(f'BOX {self.box_id}. Fetching OK response.')
+        messages = {}
+        for uid, attributes in parse_fetch_response(response.lines).items():
+            if uid <= max_uid:
+                continue
+            size = attributes.get('RFC822.SIZE') or b''
+            try:
+                messages[uid] = {
+                    'Headers': BytesHeaderParser().parsebytes(
+                        attributes.get('BODY[HEADER.FIELDS]') or b'',
+                    ),
+                    'Size': int(size) if size.isdigit() else 0,
+                    'Structure': parse_bodystructure(
+                        attributes.get('BODYSTRUCTURE'),
+                    ),
+                }
+            except Exception as error:
+                logger.error(
+                    f'BOX {self.box_id}. UID {uid} skipped, headers '
+                    f'parsing failed: {error!r}',
+                )
+        return messages
+
+    async def download_messages(
+        self,
+        imap_client: IMAP4SSLClient,
+        uids: list[int],
+    ) -> dict[int, dict[str, list[str]]]:
+        """Скачать письма целиком и извлечь их содержимое.
+
+        Письма разбираются потоково по мере получения, содержимое
+        их нетекстовых частей не сохраняется."""
+        response = await imap_client.uid_fetch_parsed(
+            ','.join(str(uid) for uid in uids),
+            '(UID BODY.PEEK[])',
+            message_stream_parser,
+        )
+        contents = {}
+        for uid, attributes in parse_fetch_response(response.lines).items():
+            if not isinstance(attributes.get('BODY[]'), Message):
+                continue
+            try:
+                contents[uid] = await self.mail_processor.extract_content(
+                    attributes['BODY[]'],
+                )
+            except Exception as error:
+                logger.error(
+                    f'BOX {self.box_id}. UID {uid} parsing failed: '
+                    f'{error!r}',
+                )
+        return contents
+
+    async def download_message_sections(
+        self,
+        imap_client: IMAP4SSLClient,
+        uid: int,
+        structure: dict[str, list[Any]],
+    ) -> dict[str, list[str]]:
+        """Скачать только текстовые части письма по его BODYSTRUCTURE.
+
+        Каждая часть обрезается до TEXT_PART_MAX_SIZE байт, названия
+        вложений берутся из структуры, сами вложения не скачиваются.
+        Крупные части декодируются в пуле процессов."""
+        sections = structure['text']
+        attributes = {}
+        if sections:
+            response = await imap_client.uid(
+                'fetch',
+                str(uid),
+                '(UID %s)' % ' '.join(
+                    'BODY.PEEK[%s]<0.%d>' % (
+                        section['section'],
+                        settings.TEXT_PART_MAX_SIZE,
+                    )
+                    for section in sections
+                ),
+            )
+            attributes = parse_fetch_response(response.lines).get(uid, {})
+        data = [
+            attributes.get('BODY[%s]' % section['section']) or b''
+            for section in sections
+        ]
+        return {
+            'Text': await parse_pool.run(
+                sum(len(section_data) for section_data in data),
+                decode_body_sections,
+                data,
+                sections,
             ),
+            'Attachments': structure['attachments'],
+            'Types': [section['type'] for section in sections],
+        }
+
+    async def process_messages(
+        self,
+        contents: dict[int, dict[str, list[str]]],
+        messages: dict[int, dict[str, Any]],
+        senders: dict[int, str],
+    ) -> None:
+        """Отправить письма на обработку."""
+        results = await asyncio.gather(
+            *(
+                self.mail_processor.process_new_message(
+                    headers=messages[uid]['Headers'],
+                    content=content,
+                    sender=senders[uid],
+                    box_id=self.box_id,
+                    telegram_id=self.telegram_id,
+                    username=self.username,
+                )
+                for uid, content in contents.items()
+            ),
+            return_exceptions=True,
+        )
+        for uid, result in zip(contents, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f'BOX {self.box_id}. UID {uid} failed: {result!r}',
+                )
+
+    def cap_backlog(
+        self,
+        uids: list[int],
+        limit: int,
+        description: str,
+    ) -> list[int]:
+        """Оставить не больше limit последних писем uids."""
+        if len(uids) <= limit:
+            return uids
+        logger.warning(
+            f'BOX {self.box_id}. Backlog of {len(uids)} {description}, '
+            f'skipping {len(uids) - limit}.',
         )
-        new_max_uid = max_uid
-        last_message_headers = None
-        if response.result == 'OK':
-            logger.info(f'BOX {self.box_id}. Fetching OK response.')
-            fetch_command_without_literal = b'%s %s' % (
-                response.lines[-4],
-                response.lines[-2],
+        return uids[-limit:]
+
+    async def fetch_new_messages(
+        self,
+        imap_client: IMAP4SSLClient,
+        changed_since: int | None = None,
+    ) -> None:
+        """Обработать все письма новее последнего обработанного UID.
+
+        Если у ящика немного фильтров, письма сначала отбираются поиском
+        на сервере. Отправители и тема проверяются по заголовкам, тела
+        скачиваются только у подходящих под фильтры писем пачками
+        по BACKLOG_CONCURRENCY, водяной знак сохраняется после
+        каждой пачки. Если у ящика есть фильтры по тексту, тела
+        остальных писем тоже скачиваются и проверяются по ним.
+        Из подходящих писем обрабатываются последние
+        BACKLOG_MAX_MESSAGES, из проверяемых по тексту - отдельно
+        последние BACKLOG_MAX_BODY_CHECKS.
+        Небольшие письма скачиваются целиком, у крупных скачиваются
+        только текстовые части. С changed_since заголовки запрашиваются
+        только у писем, измененных после этого MODSEQ."""
+        criteria = await self.mail_processor.get_sender_search(
+            box_id=self.box_id,
+            telegram_id=self.telegram_id,
+        )
+        candidate_uids = None
+        if criteria:
+            candidate_uids = await self.search_new_uids(
+                imap_client=imap_client,
+                max_uid=self.current_max_uid,
+                criteria=criteria,
             )
-            match_result = FETCH_MESSAGE_DATA_UID.match(
-                fetch_command_without_literal,
+            if candidate_uids == []:
+                return None
+        messages = await self.fetch_messages_headers(
+            imap_client=imap_client,
+            max_uid=self.current_max_uid,
+            uids=candidate_uids,
+            changed_since=changed_since,
+        )
+        uids = sorted(messages)
+        if not uids:
+            return None
+        logger.info(f'BOX {self.box_id}. Handling {len(uids)} new mails.')
+        senders = {}
+        body_uids = []
+        check_body = await self.mail_processor.has_body_keywords(
+            box_id=self.box_id,
+            telegram_id=self.telegram_id,
+        )
+        for uid in uids:
+            sender = await self.mail_processor.match_sender(
+                headers=messages[uid]['Headers'],
+                box_id=self.box_id,
+                telegram_id=self.telegram_id,
             )
-            if match_result:
-                uid = int(match_result.group('uid'))
-                last_message_headers = BytesHeaderParser().parsebytes(
-                    response.lines[-3],
+            if sender:
+                senders[uid] = sender
+            elif check_body:
+                body_uids.append(uid)
+        sender_uids = self.cap_backlog(
+            list(senders),
+            settings.BACKLOG_MAX_MESSAGES,
+            'matched messages',
+        )
+        senders = {uid: senders[uid] for uid in sender_uids}
+        body_uids = self.cap_backlog(
+            body_uids,
+            settings.BACKLOG_MAX_BODY_CHECKS,
+            'messages to check by text',
+        )
+        matched_uids = sorted([*sender_uids, *body_uids])
+        batch_size = settings.BACKLOG_CONCURRENCY
+        for index in range(0, len(matched_uids), batch_size):
+            batch_uids = matched_uids[index:index + batch_size]
+            full_uids = [
+                uid for uid in batch_uids
+                if messages[uid]['Structure'] is None or (
+                    messages[uid]['Size'] <= settings.FULL_FETCH_MAX_SIZE
                 )
-                new_max_uid = uid
-            if last_message_headers and return_message:
-                logger.info(f'BOX {self.box_id}. Handling new mail.')
-                dwnld_resp = await imap_client.uid(
-                    'fetch',
-                    str(uid),
-                    'BODY.PEEK[]',
+            ]
+            contents = {}
+            if full_uids:
+                contents.update(
+                    await self.download_messages(
+                        imap_client=imap_client,
+                        uids=full_uids,
+                    ),
                 )
-                raw_email = dwnld_resp.lines[1]
-                decode_message = email.message_from_bytes(raw_email)
-                await self.mail_processor.process_new_message(
-                    message=decode_message,
+            for uid in batch_uids:
+                if uid not in full_uids:
+                    contents[uid] = await self.download_message_sections(
+                        imap_client=imap_client,
+                        uid=uid,
+                        structure=messages[uid]['Structure'],
+                    )
+            for uid in batch_uids:
+                if uid in senders or uid not in contents:
+                    continue
+                sender = await self.mail_processor.match_body(
+                    headers=messages[uid]['Headers'],
+                    content=contents[uid],
                     box_id=self.box_id,
                     telegram_id=self.telegram_id,
-                    username=username,
                 )
-        return new_max_uid
+                if sender:
+                    senders[uid] = sender
+                else:
+                    del contents[uid]
+            await self.process_messages(contents, messages, senders)
+            self.current_max_uid = batch_uids[-1]
+            await self.save_uid_state()
+        self.current_max_uid = uids[-1]
+        await self.save_uid_state()
 
     async def handle_server_push(
         self,
@@ -263,46 +667,169 @@ class IMAPClient:
                 logger.info(f'BOX {self.box_id}. Another push : %r' % msg)
         return False
 
-    async def imap_loop(self) -> None:
-        """Loop для работы с почтовыми ящиками."""
+    async def poll_new_messages(
+        self,
+        imap_client: IMAP4SSLClient,
+        connection_lost: asyncio.Event,
+    ) -> None:
+        """Проверить наличие новых писем и обработать их."""
+        if connection_lost.is_set():
+            raise ConnectionError('IMAP connection lost')
+        response = await imap_client.uid_search(
+            'UID', '%d:*' % (self.current_max_uid + 1),
+            charset=None,
+        )
+        if response.result != 'OK':
+            raise ImapConnectionError(IMAP_CONNECTION_ERROR)
+        if any(
+            uid > self.current_max_uid
+            for uid in parse_search_response(response.lines)
+        ):
+            await self.fetch_new_messages(imap_client)
+
+    async def poll(
+        self,
+        imap_client: IMAP4SSLClient,
+        connection_lost: asyncio.Event,
+    ) -> None:
+        """Опрашивать ящик на сервере без IDLE общим планировщиком.
+
+        Завершается исключением первого неудачного опроса."""
+        logger.info(
+            f'BOX {self.box_id}. Server has no IDLE, '
+            f'polling every {self.poll_interval} s.',
+        )
         try:
+            await poll_scheduler.register(
+                self.box_id,
+                partial(self.poll_new_messages, imap_client, connection_lost),
+                self.poll_interval,
+            )
+        finally:
+            poll_scheduler.unregister(self.box_id)
+
+    @staticmethod
+    def close_connection(imap_client: IMAP4SSLClient) -> None:
+        """Закрыть соединение, если оно еще открыто."""
+        transport = imap_client.protocol.transport
+        if transport is not None and not transport.is_closing():
+            transport.close()
+
+    async def connect(
+        self,
+        connection_lost: asyncio.Event,
+    ) -> IMAP4SSLClient:
+        """Подключиться к серверу и войти в ящик.
+
+        Подключение ограничивается по серверу и ждет, пока разомкнут
+        предохранитель сервера. При обрыве соединения
+        устанавливается connection_lost и прерывается ожидание IDLE."""
+
+        def on_connection_lost(error: Exception | None) -> None:
+            connection_lost.set()
+            imap_client.protocol.idle_queue.put_nowait(
+                aioimaplib.STOP_WAIT_SERVER_PUSH,
+            )
+
+        async with (
+            host_breaker.attempt(self.host),
+            host_limiter.acquire(self.host),
+        ):
             logger.info(f'BOX {self.box_id}. Connecting IMAP.')
-            imap_client = aioimaplib.IMAP4_SSL(
+            imap_client = IMAP4SSLClient(
                 host=self.host,
                 port=self.port,
                 timeout=60,
+                conn_lost_cb=on_connection_lost,
             )
-            await imap_client.wait_hello_from_server()
+            try:
+                await imap_client.wait_hello_from_server()
+                enable_tcp_keepalive(imap_client.protocol.transport)
 
-            logger.info(f'BOX {self.box_id}. Logining in IMAP.')
-            await imap_client.login(self.username, self.password)
+                logger.info(f'BOX {self.box_id}. Logining in IMAP.')
+                response = await imap_client.login(
+                    self.username,
+                    self.password,
+                )
+                if response.result != 'OK':
+                    raise ImapAuthenticationFailed(IMAP_AUTHENTICATION_FAILED)
+                await capability_cache.apply(imap_client, self.host)
+                if self.use_compression and await enable_compression(
+                    imap_client,
+                ):
+                    logger.info(f'BOX {self.box_id}. Compression enabled.')
+            except BaseException:
+                self.close_connection(imap_client)
+                raise
+        self.login_attempted.set()
+        return imap_client
 
-            select_response = await imap_client.select('INBOX')
+    async def listen(self) -> None:
+        """Подключиться к ящику и слушать его до остановки слушателя.
 
-            for i in select_response[1]:
-                if b'UIDNEXT' in i:
-                    match = re.search(r'UIDNEXT (\d+)', i.decode())
-                    if match:
-                        uidnext = int(match.group(1))
-                        self.current_max_uid = uidnext - 1
-                        break
-
-            redis_key = await self.redis.gen_key(
-                telegram_id=self.telegram_id,
-                box_id=self.box_id,
+        Исключения соединения пробрасываются в imap_loop, при отмене
+        задачи соединение закрывается."""
+        connection_lost = asyncio.Event()
+        imap_client = await self.connect(connection_lost)
+        try:
+            condstore = 'CONDSTORE' in imap_client.protocol.capabilities
+            select_response = await imap_client.select(
+                'INBOX (CONDSTORE)' if condstore else 'INBOX',
             )
+            if select_response.result != 'OK':
+                raise ImapConnectionError(IMAP_CONNECTION_ERROR)
+            reconnect_scheduler.succeeded(self.box_id)
+
+            select_data = {}
+            for i in select_response[1]:
+                match = SELECT_UID_DATA.search(i)
+                if match:
+                    select_data[match.group('name')] = int(
+                        match.group('value'),
+                    )
+
+            highest_modseq = select_data.get(b'HIGHESTMODSEQ')
+            if await self.restore_uid_state(
+                uidvalidity=select_data.get(b'UIDVALIDITY', 0),
+                uidnext=select_data.get(b'UIDNEXT', 1),
+            ):
+                changed_since = None
+                if highest_modseq is not None:
+                    changed_since = self.highest_modseq
+                await self.fetch_new_messages(imap_client, changed_since)
+            if self.highest_modseq != highest_modseq:
+                self.highest_modseq = highest_modseq
+                await self.save_uid_state()
+
+            if 'IDLE' not in imap_client.protocol.capabilities:
+                await self.poll(imap_client, connection_lost)
+                return None
 
             return_message = False
+            idle_timeout = await idle_timeout_tuner.get(self.host)
+            loop = asyncio.get_running_loop()
 
-            while await self.redis.get(redis_key) == settings.ACTIVE_VALUE:
+            while True:
                 logger.info(f'BOX {self.box_id}. New while loop.')
-                logger.info(f'BOX {self.box_id}. Starting idle.')
-                idle_task = await imap_client.idle_start(timeout=59)
+                logger.info(
+                    f'BOX {self.box_id}. Starting idle '
+                    f'for {idle_timeout} s.',
+                )
+                idle_task = await imap_client.idle_start(timeout=idle_timeout)
+                idle_started = loop.time()
 
                 logger.info(f'BOX {self.box_id}. Waiting server push.')
-                if await self.handle_server_push(
-                    await imap_client.wait_server_push()
-                ):
+                push_messages = await imap_client.wait_server_push(
+                    timeout=idle_timeout + 60,
+                )
+                if connection_lost.is_set():
+                    await idle_timeout_tuner.disconnected(
+                        self.host,
+                        idle_timeout,
+                        loop.time() - idle_started,
+                    )
+                    raise ConnectionError('IMAP connection lost in IDLE')
+                if await self.handle_server_push(push_messages):
                     return_message = True
 
                 logger.info(f'BOX {self.box_id}. Ending idle.')
@@ -311,23 +838,33 @@ class IMAPClient:
                 await wait_for(idle_task, timeout=60)
 
                 if return_message:
-                    self.current_max_uid = await self.fetch_messages_headers(
-                        imap_client=imap_client,
-                        max_uid=self.current_max_uid,
-                        username=self.username,
-                        return_message=return_message,
-                    )
+                    await self.fetch_new_messages(imap_client)
                     return_message = False
-            logger.info(f'BOX {self.box_id}. Logining out IMAP.')
-            await imap_client.logout()
-        except asyncio.TimeoutError:
-            logger.error(f'BOX {self.box_id}. Loop timeout.')
-            self.restart_loop = True
+        finally:
+            self.close_connection(imap_client)
 
-        if self.restart_loop:
-            logger.info(f'BOX {self.box_id}. Restarting imap_loop.')
-            self.restart_loop = False
-            await self.imap_loop()
+    async def imap_loop(self) -> None:
+        """Loop для работы с почтовыми ящиками.
+
+        При ошибках соединения переподключается с задержкой
+        из общего планировщика переподключений. После исчерпания
+        попыток следующая серия начинается через RECONNECT_COOLDOWN
+        секунд, чтобы ящик не замолкал после временного сбоя
+        почтового сервера."""
+        while True:
+            try:
+                await self.listen()
+            except RECONNECT_ERRORS as error:
+                logger.error(f'BOX {self.box_id}. Loop error: {error!r}')
+            self.login_attempted.set()
+            delay = reconnect_scheduler.failed(self.box_id)
+            if delay is None:
+                delay = settings.RECONNECT_COOLDOWN
+                logger.error(f'BOX {self.box_id}. Reconnect attempts over.')
+            logger.info(
+                f'BOX {self.box_id}. Reconnecting in {delay:.1f} s.',
+            )
+            await asyncio.sleep(delay)
 
 
 class IMAPListener:
@@ -341,6 +878,8 @@ class IMAPListener:
         password: str,
         telegram_id: int,
         box_id: int,
+        poll_interval: int,
+        use_compression: bool,
     ):
         self.imap_client: IMAPClient = IMAPClient(
             host=host,
@@ -349,13 +888,224 @@ class IMAPListener:
             password=password,
             telegram_id=telegram_id,
             box_id=box_id,
+            poll_interval=poll_interval,
+            use_compression=use_compression,
         )
         self._task: asyncio.Task | None = None
 
+    @property
+    def box_id(self) -> int:
+        """Идентификатор прослушиваемого ящика."""
+        return self.imap_client.box_id
+
+    @property
+    def task(self) -> asyncio.Task | None:
+        """Задача цикла прослушивания."""
+        return self._task
+
+    @property
+    def is_running(self) -> bool:
+        """Работает ли цикл прослушивания."""
+        return self._task is not None and not self._task.done()
+
     async def start(self) -> None:
         """Запустить слушатель."""
-        if self._task is None:
+        if not self.is_running:
             self._task = asyncio.create_task(self.imap_client.imap_loop())
         logger.info(
             f'BOX {self.imap_client.box_id}. Started IMAP Listener.',
         )
+
+    async def wait_login_attempt(self) -> None:
+        """Дождаться первой попытки входа в ящик или завершения цикла."""
+        if not self.is_running:
+            return None
+        login_attempted = asyncio.create_task(
+            self.imap_client.login_attempted.wait(),
+        )
+        try:
+            await asyncio.wait(
+                {login_attempted, self._task},
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            login_attempted.cancel()
+
+    async def stop(self) -> None:
+        """Остановить слушатель."""
+        if self.is_running:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+        logger.info(
+            f'BOX {self.imap_client.box_id}. Stopped IMAP Listener.',
+        )
+
+
+class ListenerSupervisor:
+    """Реестр слушателей почтовых ящиков процесса.
+
+    Хранит не более одного слушателя на ящик, останавливает слушатели
+    при деактивации и перезапускает циклы, завершившиеся с ошибкой.
+    """
+
+    def __init__(self):
+        self._listeners: dict[int, IMAPListener] = {}
+        self._restarts: dict[int, int] = {}
+        self._exhausted: dict[int, float] = {}
+
+    def __contains__(self, box_id: int) -> bool:
+        return box_id in self._listeners
+
+    def __len__(self) -> int:
+        return len(self._listeners)
+
+    @property
+    def box_ids(self) -> list[int]:
+        """Идентификаторы ящиков под наблюдением."""
+        return list(self._listeners)
+
+    @property
+    def running_count(self) -> int:
+        """Количество работающих циклов прослушивания."""
+        return sum(
+            listener.is_running for listener in self._listeners.values()
+        )
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики слушателей."""
+        return {
+            'total': len(self._listeners),
+            'running': self.running_count,
+            'restarts': sum(self._restarts.values()),
+            'exhausted': sum(
+                self.is_exhausted(box_id) for box_id in list(self._exhausted)
+            ),
+        }
+
+    def is_exhausted(self, box_id: int) -> bool:
+        """Исчерпал ли слушатель ящика попытки перезапуска менее
+        RECONNECT_COOLDOWN секунд назад."""
+        retry_at = self._exhausted.get(box_id)
+        if retry_at is None:
+            return False
+        if retry_at <= time.monotonic():
+            del self._exhausted[box_id]
+            return False
+        return True
+
+    def forget(self, box_id: int) -> None:
+        """Разрешить снова запускать слушатель ящика."""
+        self._exhausted.pop(box_id, None)
+
+    def _exhaust(self, box_id: int) -> None:
+        """Не запускать слушатель ящика RECONNECT_COOLDOWN секунд."""
+        self._exhausted[box_id] = (
+            time.monotonic() + settings.RECONNECT_COOLDOWN
+        )
+
+    async def start(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        telegram_id: int,
+        box_id: int,
+        poll_interval: int,
+        use_compression: bool,
+    ) -> bool:
+        """Запустить слушатель ящика, если он еще не запущен."""
+        self._exhausted.pop(box_id, None)
+        listener = self._listeners.get(box_id)
+        if listener is not None and listener.is_running:
+            logger.info(f'BOX {box_id}. Listener already running.')
+            return False
+        listener = IMAPListener(
+            host=host,
+            port=port,
+            username=username,
+            password=password,
+            telegram_id=telegram_id,
+            box_id=box_id,
+            poll_interval=poll_interval,
+            use_compression=use_compression,
+        )
+        self._listeners[box_id] = listener
+        await self._run(listener)
+        return True
+
+    async def stop(self, box_id: int) -> bool:
+        """Остановить слушатель ящика."""
+        listener = self._listeners.pop(box_id, None)
+        self._restarts.pop(box_id, None)
+        reconnect_scheduler.reset(box_id)
+        if listener is None:
+            return False
+        await listener.stop()
+        return True
+
+    async def wait_login_attempt(self, box_id: int) -> None:
+        """Дождаться первой попытки входа слушателя ящика."""
+        listener = self._listeners.get(box_id)
+        if listener is not None:
+            await listener.wait_login_attempt()
+
+    async def stop_all(self) -> None:
+        """Остановить все слушатели."""
+        await asyncio.gather(
+            *(self.stop(box_id) for box_id in self.box_ids),
+        )
+
+    async def _run(self, listener: IMAPListener) -> None:
+        """Запустить цикл слушателя и подписаться на его завершение."""
+        await listener.start()
+        listener.task.add_done_callback(
+            partial(self._on_listener_done, listener),
+        )
+
+    def _on_listener_done(
+        self,
+        listener: IMAPListener,
+        task: asyncio.Task,
+    ) -> None:
+        """Обработать завершение цикла прослушивания."""
+        box_id = listener.box_id
+        if self._listeners.get(box_id) is not listener:
+            return
+        if task.cancelled() or task.exception() is None:
+            logger.info(f'BOX {box_id}. Listener finished.')
+            self._listeners.pop(box_id, None)
+            self._restarts.pop(box_id, None)
+            reconnect_scheduler.reset(box_id)
+            if not task.cancelled():
+                self._exhaust(box_id)
+            return
+        delay = reconnect_scheduler.failed(box_id)
+        if delay is None:
+            logger.error(
+                f'BOX {box_id}. Listener crashed: {task.exception()!r}. '
+                'Restart attempts over.',
+            )
+            self._listeners.pop(box_id, None)
+            self._restarts.pop(box_id, None)
+            self._exhaust(box_id)
+            return
+        logger.error(
+            f'BOX {box_id}. Listener crashed: {task.exception()!r}. '
+            f'Restarting in {delay:.1f} s.',
+        )
+        self._restarts[box_id] = self._restarts.get(box_id, 0) + 1
+        asyncio.get_running_loop().call_later(
+            delay,
+            lambda: asyncio.ensure_future(self._restart(listener)),
+        )
+
+    async def _restart(self, listener: IMAPListener) -> None:
+        """Перезапустить упавший слушатель, если он еще нужен."""
+        if self._listeners.get(listener.box_id) is not listener:
+            return
+        await self._run(listener)
+
+
+listener_supervisor: ListenerSupervisor = ListenerSupervisor()
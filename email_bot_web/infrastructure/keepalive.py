@@ -0,0 +1,68 @@
+import socket
+
+from django.conf import settings
+
+from infrastructure.redis_service import redis_client
+
+IDLE_TIMEOUT_MARGIN = 0.8
+
+
+def enable_tcp_keepalive(transport) -> None:
+    """Включить TCP keepalive на сокете соединения.
+
+    Мертвое соединение обнаруживается ядром, не дожидаясь окончания
+    длинного IDLE."""
+    sock = transport.get_extra_info('socket')
+    if sock is None:
+        return None
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    options = (
+        ('TCP_KEEPIDLE', settings.TCP_KEEPALIVE_IDLE),
+        ('TCP_KEEPINTVL', settings.TCP_KEEPALIVE_INTERVAL),
+        ('TCP_KEEPCNT', settings.TCP_KEEPALIVE_COUNT),
+    )
+    for name, value in options:
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+class IdleTimeoutTuner:
+    """Подбор длительности IDLE для почтового сервера.
+
+    По умолчанию IDLE длится рекомендованные RFC 2177 29 минут.
+    Если сервер обрывает соединение раньше, длительность для него
+    сокращается до доли наблюдаемого времени обрыва и хранится
+    в redis ограниченное время, после чего снова проверяется
+    длительность по умолчанию.
+    """
+
+    def __init__(self):
+        self.redis = redis_client
+
+    async def get(self, host: str) -> int:
+        """Получить длительность IDLE для сервера."""
+        timeout = await self.redis.get(
+            settings.IDLE_TIMEOUT_KEY.format(host=host),
+        )
+        return timeout or settings.IDLE_MAX_TIMEOUT
+
+    async def disconnected(
+        self,
+        host: str,
+        timeout: int,
+        elapsed: float,
+    ) -> None:
+        """Учесть обрыв соединения сервером во время IDLE.
+
+        Слишком ранние обрывы считаются сетевыми сбоями и не влияют
+        на длительность."""
+        if elapsed < settings.IDLE_MIN_TIMEOUT or elapsed >= timeout:
+            return None
+        await self.redis.set(
+            settings.IDLE_TIMEOUT_KEY.format(host=host),
+            max(settings.IDLE_MIN_TIMEOUT, int(elapsed * IDLE_TIMEOUT_MARGIN)),
+            settings.IDLE_TIMEOUT_TTL,
+        )
+
+
+idle_timeout_tuner: IdleTimeoutTuner = IdleTimeoutTuner()
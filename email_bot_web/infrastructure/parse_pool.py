@@ -0,0 +1,63 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable
+
+from django.conf import settings
+
+
+class ParsePool:
+    """Пул процессов для декодирования крупных текстовых частей писем.
+
+    Декодирование занимает процессор, и крупная часть, декодированная
+    в цикле событий, задерживает обслуживание остальных ящиков.
+    Данные от PARSE_OFFLOAD_MIN_SIZE байт декодируются в отдельных
+    процессах, небольшие - на месте, без накладных расходов
+    на передачу между процессами. Если процесс пула аварийно
+    завершился, пул создается заново при следующем вызове.
+    """
+
+    def __init__(self):
+        self._executor: ProcessPoolExecutor | None = None
+        self._inline = 0
+        self._offloaded = 0
+
+    async def run(self, size: int, func: Callable[..., Any], *args) -> Any:
+        """Выполнить обработку данных размера size.
+
+        func и аргументы должны передаваться между процессами."""
+        if size < settings.PARSE_OFFLOAD_MIN_SIZE:
+            self._inline += 1
+            return func(*args)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=settings.PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        self._offloaded += 1
+        executor = self._executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor,
+                func,
+                *args,
+            )
+        except BrokenProcessPool:
+            if self._executor is executor:
+                self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    def shutdown(self) -> None:
+        """Остановить процессы пула."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики разбора."""
+        return {'inline': self._inline, 'offloaded': self._offloaded}
+
+
+parse_pool: ParsePool = ParsePool()
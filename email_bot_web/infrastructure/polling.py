@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from django.conf import settings
+
+logger = logging.getLogger('imap')
+
+
+@dataclass
+class PollEntry:
+    """Ящик, опрашиваемый планировщиком."""
+
+    box_id: int
+    poll: Callable[[], Awaitable[None]]
+    interval: int
+    result: asyncio.Future
+    rounds: int = 0
+    slot: int = 0
+
+
+class PollScheduler:
+    """Планировщик опроса ящиков на серверах без IDLE.
+
+    Колесо таймеров из POLL_WHEEL_SIZE ячеек по секунде: ящик кладется
+    в ячейку, до которой осталось его время опроса, а интервалы длиннее
+    колеса отсчитываются оборотами. Одна задача проворачивает колесо
+    и пачкой опрашивает ящики наступившей ячейки, после опроса ящик
+    снова ставится в колесо.
+    """
+
+    def __init__(self):
+        self._slots: list[dict[int, PollEntry]] = [
+            {} for _ in range(settings.POLL_WHEEL_SIZE)
+        ]
+        self._entries: dict[int, PollEntry] = {}
+        self._cursor = 0
+        self._task: asyncio.Task | None = None
+        self._batches: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, box_id: int) -> bool:
+        return box_id in self._entries
+
+    def register(
+        self,
+        box_id: int,
+        poll: Callable[[], Awaitable[None]],
+        interval: int,
+    ) -> asyncio.Future:
+        """Поставить ящик на опрос.
+
+        Возвращает future, который завершается исключением опроса,
+        после чего ящик снимается с опроса."""
+        self.unregister(box_id)
+        entry = PollEntry(
+            box_id=box_id,
+            poll=poll,
+            interval=max(1, interval),
+            result=asyncio.get_running_loop().create_future(),
+        )
+        self._entries[box_id] = entry
+        self._schedule(entry)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return entry.result
+
+    def unregister(self, box_id: int) -> None:
+        """Снять ящик с опроса."""
+        entry = self._entries.pop(box_id, None)
+        if entry is None:
+            return None
+        self._slots[entry.slot].pop(box_id, None)
+        if not entry.result.done():
+            entry.result.cancel()
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики опроса."""
+        return {'polled': len(self._entries)}
+
+    def _schedule(self, entry: PollEntry) -> None:
+        """Положить ящик в ячейку колеса через его интервал."""
+        rounds, offset = divmod(entry.interval, len(self._slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self._slots)
+        entry.rounds = rounds
+        entry.slot = (self._cursor + offset) % len(self._slots)
+        self._slots[entry.slot][entry.box_id] = entry
+
+    async def _run(self) -> None:
+        """Проворачивать колесо, пока есть опрашиваемые ящики."""
+        while self._entries:
+            await asyncio.sleep(1)
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            due = []
+            for entry in list(slot.values()):
+                if entry.rounds:
+                    entry.rounds -= 1
+                    continue
+                del slot[entry.box_id]
+                due.append(entry)
+            if due:
+                batch = asyncio.create_task(self._poll_batch(due))
+                self._batches.add(batch)
+                batch.add_done_callback(self._batches.discard)
+
+    async def _poll_batch(self, entries: list[PollEntry]) -> None:
+        """Опросить пачку ящиков и поставить их в колесо снова."""
+        results = await asyncio.gather(
+            *(entry.poll() for entry in entries),
+            return_exceptions=True,
+        )
+        for entry, result in zip(entries, results):
+            if self._entries.get(entry.box_id) is not entry:
+                continue
+            if isinstance(result, BaseException):
+                logger.error(f'BOX {entry.box_id}. Poll failed: {result!r}')
+                del self._entries[entry.box_id]
+                entry.result.set_exception(result)
+                continue
+            self._schedule(entry)
+
+
+poll_scheduler: PollScheduler = PollScheduler()
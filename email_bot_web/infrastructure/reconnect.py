@@ -0,0 +1,50 @@
+import random
+
+from django.conf import settings
+
+
+class ReconnectScheduler:
+    """Планировщик переподключений слушателей.
+
+    Общий для всех слушателей процесса: считает неудачные попытки
+    каждого ящика и выдает задержку перед следующей попыткой,
+    растущую экспоненциально, со случайным разбросом.
+    """
+
+    def __init__(self):
+        self._attempts: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._attempts)
+
+    def failed(self, box_id: int) -> float | None:
+        """Зарегистрировать неудачу и получить задержку перед
+        переподключением или None, если попытки исчерпаны."""
+        attempt = self._attempts.get(box_id, 0)
+        if attempt >= settings.RECONNECT_MAX_RETRIES:
+            self._attempts.pop(box_id, None)
+            return None
+        self._attempts[box_id] = attempt + 1
+        delay = min(
+            settings.RECONNECT_MAX_DELAY,
+            settings.RECONNECT_BASE_DELAY * 2 ** attempt,
+        )
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def succeeded(self, box_id: int) -> None:
+        """Сбросить счетчик попыток после успешного входа в ящик."""
+        self._attempts.pop(box_id, None)
+
+    def reset(self, box_id: int) -> None:
+        """Забыть попытки остановленного слушателя."""
+        self._attempts.pop(box_id, None)
+
+    def stats(self) -> dict[str, int]:
+        """Счетчики переподключений."""
+        return {
+            'reconnecting': len(self._attempts),
+            'attempts': sum(self._attempts.values()),
+        }
+
+
+reconnect_scheduler: ReconnectScheduler = ReconnectScheduler()
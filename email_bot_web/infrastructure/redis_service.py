@@ -1,9 +1,30 @@
+import asyncio
+import json
+import logging
 import pickle
+from contextlib import suppress
 from functools import wraps
-from typing import Any, Callable
+from typing import Any, AsyncIterator, Callable
 
 from django.conf import settings
 from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger('imap')
+EXPIRE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+DELETE_IF_EQUAL = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
 
 class RedisClient:
@@ -32,6 +53,15 @@ class RedisClient:
         """Установить значение по ключу."""
         cache.set(key, value, timeout)
 
+    async def add(
+        self,
+        key: str,
+        value: str,
+        timeout: int | None = None,
+    ) -> bool:
+        """Установить значение, только если ключ отсутствует."""
+        return cache.add(key, value, timeout)
+
     async def delete(self, key: str) -> None:
         """Удалить значение по ключу."""
         cache.delete(key)
@@ -44,6 +74,103 @@ class RedisClient:
         """Получить все ключи по шаблону."""
         return cache.keys(pattern)
 
+    async def touch_if_equal(
+        self,
+        key: str,
+        value: str,
+        timeout: int,
+    ) -> bool:
+        """Атомарно обновить время жизни ключа, если он хранит value."""
+        return bool(get_redis_connection('default').eval(
+            EXPIRE_IF_EQUAL,
+            1,
+            cache.client.make_key(key),
+            cache.client.encode(value),
+            timeout,
+        ))
+
+    async def delete_if_equal(self, key: str, value: str) -> bool:
+        """Атомарно удалить ключ, если он хранит value."""
+        return bool(get_redis_connection('default').eval(
+            DELETE_IF_EQUAL,
+            1,
+            cache.client.make_key(key),
+            cache.client.encode(value),
+        ))
+
+    async def set_score(self, key: str, member: str, score: float) -> None:
+        """Добавить элемент в сортированное множество или обновить
+        его вес."""
+        get_redis_connection('default').zadd(
+            cache.client.make_key(key),
+            {member: score},
+        )
+
+    async def get_members_from(self, key: str, min_score: float) -> list[str]:
+        """Получить элементы сортированного множества с весом
+        не меньше min_score."""
+        members = get_redis_connection('default').zrangebyscore(
+            cache.client.make_key(key),
+            min_score,
+            '+inf',
+        )
+        return [member.decode() for member in members]
+
+    async def remove_members_below(self, key: str, max_score: float) -> None:
+        """Удалить элементы сортированного множества с весом
+        меньше max_score."""
+        get_redis_connection('default').zremrangebyscore(
+            cache.client.make_key(key),
+            '-inf',
+            f'({max_score}',
+        )
+
+    async def remove_member(self, key: str, member: str) -> None:
+        """Удалить элемент сортированного множества."""
+        get_redis_connection('default').zrem(
+            cache.client.make_key(key),
+            member,
+        )
+
+    async def publish(self, channel: str, message: dict[str, Any]) -> None:
+        """Опубликовать сообщение в канал."""
+        get_redis_connection('default').publish(channel, json.dumps(message))
+
+    async def listen(
+        self,
+        channel: str,
+        on_subscribe: Callable[[], None] | None = None,
+    ) -> AsyncIterator[dict[str, Any]]:
+        """Получать сообщения из канала.
+
+        При потере соединения с redis подписка восстанавливается
+        с растущей задержкой до PUBSUB_RECONNECT_MAX_DELAY секунд.
+        Сообщения, опубликованные за время обрыва, теряются, поэтому
+        после каждой подписки вызывается on_subscribe."""
+        delay = 1
+        while True:
+            connection = aioredis.from_url(settings.REDIS_URL)
+            pubsub = connection.pubsub()
+            try:
+                await pubsub.subscribe(channel)
+                delay = 1
+                if on_subscribe is not None:
+                    on_subscribe()
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        yield json.loads(message['data'])
+            except (RedisError, OSError) as error:
+                logger.warning(
+                    f'Channel {channel} lost: {error!r}. '
+                    f'Resubscribing in {delay} s.',
+                )
+            finally:
+                with suppress(RedisError, OSError):
+                    await pubsub.aclose()
+                    await connection.aclose()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, settings.PUBSUB_RECONNECT_MAX_DELAY)
+
     def cache_result(
         self,
         key_format: str,
@@ -0,0 +1,103 @@
+import hashlib
+import os
+import socket
+import time
+from uuid import uuid4
+
+from django.conf import settings
+
+from infrastructure.redis_service import redis_client
+
+
+class ListenerNode:
+    """Узел сервиса прослушивания в кластере.
+
+    Ящики распределяются между живыми узлами рандеву-хешированием,
+    а право на прослушивание ящика подтверждается арендой в redis,
+    поэтому при появлении или падении узла ящики перераспределяются
+    без одновременного прослушивания одного ящика двумя узлами.
+    """
+
+    def __init__(self, node_id: str | None = None):
+        self.node_id = node_id or '{host}-{pid}-{suffix}'.format(
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            suffix=uuid4().hex[:8],
+        )
+        self.redis = redis_client
+
+    async def heartbeat(self) -> None:
+        """Продлить регистрацию узла и удалить из реестра узлы,
+        не продлевавшие регистрацию LISTENER_NODE_TTL секунд."""
+        now = time.time()
+        await self.redis.set_score(
+            settings.LISTENER_NODES_KEY,
+            self.node_id,
+            now,
+        )
+        await self.redis.remove_members_below(
+            settings.LISTENER_NODES_KEY,
+            now - settings.LISTENER_NODE_TTL,
+        )
+
+    async def leave(self, box_ids: list[int]) -> None:
+        """Снять регистрацию узла и освободить аренды ящиков."""
+        await self.redis.remove_member(
+            settings.LISTENER_NODES_KEY,
+            self.node_id,
+        )
+        for box_id in box_ids:
+            await self.release_lease(box_id)
+
+    async def alive_nodes(self) -> list[str]:
+        """Получить идентификаторы живых узлов.
+
+        Узлы хранятся в сортированном множестве с временем последней
+        регистрации, поэтому поиск не перебирает ключи redis."""
+        nodes = set(await self.redis.get_members_from(
+            settings.LISTENER_NODES_KEY,
+            time.time() - settings.LISTENER_NODE_TTL,
+        ))
+        nodes.add(self.node_id)
+        return sorted(nodes)
+
+    @staticmethod
+    def owner(box_id: int, nodes: list[str]) -> str:
+        """Определить узел-владелец ящика."""
+        return max(
+            nodes,
+            key=lambda node_id: hashlib.sha1(
+                f'{node_id}:{box_id}'.encode(),
+            ).digest(),
+        )
+
+    def owns(self, box_id: int, nodes: list[str]) -> bool:
+        """Принадлежит ли ящик текущему узлу."""
+        return self.owner(box_id, nodes) == self.node_id
+
+    async def acquire_lease(self, box_id: int) -> bool:
+        """Взять или продлить аренду ящика.
+
+        Аренда продлевается атомарно, только если ее держит этот узел."""
+        key = settings.LISTENER_LEASE_KEY.format(box_id=box_id)
+        if await self.redis.add(
+            key,
+            self.node_id,
+            settings.LISTENER_LEASE_TTL,
+        ):
+            return True
+        return await self.redis.touch_if_equal(
+            key,
+            self.node_id,
+            settings.LISTENER_LEASE_TTL,
+        )
+
+    async def release_lease(self, box_id: int) -> None:
+        """Освободить аренду ящика, если ее держит этот узел."""
+        await self.redis.delete_if_equal(
+            settings.LISTENER_LEASE_KEY.format(box_id=box_id),
+            self.node_id,
+        )
+
+
+listener_node: ListenerNode = ListenerNode()
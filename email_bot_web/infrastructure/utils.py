@@ -1,54 +1,240 @@
+import asyncio
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Coroutine
+
 from django.conf import settings
 
-from email_service.service import ServiceEmailBox
+from email_service.models import EmailBox
 from infrastructure.crypto_service import encryptor
-from infrastructure.exceptions import (
-    ImapAuthenticationFailed,
-    ImapConnectionError,
-    ServerUnavailable,
+from infrastructure.filter_index import filter_indexes
+from infrastructure.imap_connection import (
+    host_breaker,
+    host_connector,
+    host_limiter,
 )
-from infrastructure.imap_service import IMAPClient, logger
+from infrastructure.imap_service import listener_supervisor, logger
+from infrastructure.parse_pool import parse_pool
+from infrastructure.polling import poll_scheduler
+from infrastructure.reconnect import reconnect_scheduler
 from infrastructure.redis_service import redis_client
 from infrastructure.repository import Repository
+from infrastructure.sharding import listener_node
 
-box_service = ServiceEmailBox()
 repo = Repository()
+pending_tasks: set[asyncio.Task] = set()
+starting_box_ids: set[int] = set()
+
+
+def run_in_background(coro: Coroutine[Any, Any, None]) -> None:
+    """Запустить корутину фоновой задачей службы слушателей."""
+    task = asyncio.create_task(coro)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+
+
+async def start_box_listener(box: EmailBox) -> bool:
+    """Запустить слушатель ящика.
+
+    Отдельная проверка соединения не выполняется: слушатель сам входит
+    в ящик и при ошибках переподключается."""
+    if not box.user_id.is_active:
+        return False
+    await redis_client.set(
+        await redis_client.gen_key(box.user_id.telegram_id, box.id),
+        settings.ACTIVE_VALUE,
+    )
+
+    await listener_supervisor.start(
+        host=box.email_service.address,
+        port=box.email_service.port,
+        username=box.email_username,
+        password=encryptor.decrypt_data(box.email_password),
+        telegram_id=box.user_id.telegram_id,
+        box_id=box.id,
+        poll_interval=box.email_service.poll_interval,
+        use_compression=box.email_service.use_compression,
+    )
+    return True
+
+
+async def start_owned_box(box: EmailBox) -> None:
+    """Запустить слушатель ящика, если удалось взять его аренду."""
+    if not await listener_node.acquire_lease(box.id):
+        return None
+    if not await start_box_listener(box):
+        await listener_node.release_lease(box.id)
+
+
+async def stop_box(box_id: int) -> None:
+    """Остановить слушатель ящика и освободить его аренду."""
+    await listener_supervisor.stop(box_id)
+    await listener_node.release_lease(box_id)
+
+
+async def rebalance_listeners() -> None:
+    """Привести набор слушателей узла к его доле активных ящиков."""
+    nodes = await listener_node.alive_nodes()
+    owned_boxes = {
+        box.id: box for box in await repo.box.get_all_active_boxes()
+        if listener_node.owns(box.id, nodes)
+    }
+    for box_id in listener_supervisor.box_ids:
+        if box_id not in owned_boxes:
+            logger.info(f'BOX {box_id}. Handing over to another node.')
+            await stop_box(box_id)
+    boxes = [
+        box for box_id, box in owned_boxes.items()
+        if is_startable(box_id)
+    ]
+    if boxes:
+        starting_box_ids.update(box.id for box in boxes)
+        run_in_background(start_owned_boxes(boxes))
+
+
+def is_startable(box_id: int) -> bool:
+    """Нужно ли запускать слушатель ящика при перебалансировке.
+
+    Ящик, слушатель которого исчерпал попытки перезапуска, снова
+    запускается через RECONNECT_COOLDOWN секунд."""
+    if box_id in listener_supervisor or box_id in starting_box_ids:
+        return False
+    return not listener_supervisor.is_exhausted(box_id)
 
 
-async def on_startup_imap_starter() -> None:
-    """Используется для запуска прослушки
-    всех активных ящиков при старте сервера."""
-    logger.info('RUN on_startup_imap_starter')
-    active_boxes = await repo.box.get_all_active_boxes()
+async def start_owned_boxes(boxes: list[EmailBox]) -> None:
+    """Запустить слушатели ящиков параллельно.
 
-    for box in active_boxes:
-        if not box.user_id.is_active:
-            continue
+    Запуски растягиваются с шагом STARTUP_RAMP_INTERVAL, чтобы входы
+    в ящики после старта узла не шли одной волной. Место в семафоре
+    освобождается после первой попытки входа слушателя, но не позже
+    STARTUP_LOGIN_TIMEOUT."""
+    semaphore = asyncio.Semaphore(settings.STARTUP_CONCURRENCY)
+
+    async def start(box: EmailBox, delay: float) -> None:
         try:
-            await IMAPClient.check_connection(
-                host=box.email_service.address,
-                port=box.email_service.port,
-                username=box.email_username,
-                password=encryptor.decrypt_data(box.email_password),
-            )
-        except (
-            ServerUnavailable,
-            ImapConnectionError,
-            ImapAuthenticationFailed,
-        ):
-            continue
+            await asyncio.sleep(delay)
+            async with semaphore:
+                await start_owned_box(box)
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        listener_supervisor.wait_login_attempt(box.id),
+                        settings.STARTUP_LOGIN_TIMEOUT,
+                    )
+        finally:
+            starting_box_ids.discard(box.id)
+
+    results = await asyncio.gather(
+        *(
+            start(box, index * settings.STARTUP_RAMP_INTERVAL)
+            for index, box in enumerate(boxes)
+        ),
+        return_exceptions=True,
+    )
+    for box, result in zip(boxes, results):
+        if isinstance(result, Exception):
+            logger.error(f'BOX {box.id}. Start failed: {result!r}')
+
+
+async def renew_node_leases() -> None:
+    """Продлить регистрацию узла и аренды прослушиваемых ящиков."""
+    await listener_node.heartbeat()
+    for box_id in listener_supervisor.box_ids:
+        if not await listener_node.acquire_lease(box_id):
+            logger.warning(f'BOX {box_id}. Lease lost, stopping listener.')
+            await listener_supervisor.stop(box_id)
+
+
+async def log_listener_stats() -> None:
+    """Записать в лог статистику слушателей узла."""
+    logger.info(
+        f'NODE {listener_node.node_id}. '
+        f'Listeners: {listener_supervisor.stats()}. '
+        f'Reconnects: {reconnect_scheduler.stats()}. '
+        f'Polling: {poll_scheduler.stats()}. '
+        f'Hosts: {host_limiter.stats()}. '
+        f'Open circuits: {host_breaker.stats()}. '
+        f'TLS: {host_connector.stats()}. '
+        f'Parsing: {parse_pool.stats()}.',
+    )
 
-        await redis_client.set(
-            await redis_client.gen_key(box.user_id.telegram_id, box.id),
-            settings.ACTIVE_VALUE,
-        )
 
-        await box_service.start_listener(
-            host=box.email_service.address,
-            port=box.email_service.port,
-            username=box.email_username,
-            password=encryptor.decrypt_data(box.email_password),
-            telegram_id=box.user_id.telegram_id,
-            box_id=box.id,
+async def run_periodically(
+    func: Callable[[], Awaitable[None]],
+    interval: int,
+) -> None:
+    """Вызывать корутину с заданным интервалом."""
+    while True:
+        try:
+            await func()
+        except Exception as error:
+            logger.error(f'{func.__name__} failed: {error!r}')
+        await asyncio.sleep(interval)
+
+
+async def handle_listener_command(command: dict[str, Any]) -> None:
+    """Обработать команду, полученную от веб-приложения.
+
+    Водяной знак UID остановленного по команде ящика удаляется после
+    отмены слушателя, чтобы слушатель не сохранил его заново."""
+    box_id = command.get('box_id')
+    if command.get('action') == settings.LISTENER_FILTERS_ACTION:
+        filter_indexes.invalidate(box_id)
+        return None
+    if command.get('action') == settings.LISTENER_STOP_ACTION:
+        filter_indexes.invalidate(box_id)
+        listener_supervisor.forget(box_id)
+        if box_id in listener_supervisor:
+            logger.info(f'BOX {box_id}. Stopping listener by command.')
+            await stop_box(box_id)
+            await redis_client.delete(settings.BOX_UID_STATE_KEY.format(
+                telegram_id=command.get('telegram_id'),
+                box_id=box_id,
+            ))
+        return None
+    if command.get('action') != settings.LISTENER_START_ACTION:
+        logger.warning(f'Unknown listener command: {command!r}')
+        return None
+    if not listener_node.owns(box_id, await listener_node.alive_nodes()):
+        return None
+    box = await repo.box.get_active_box(box_id)
+    if box is None:
+        logger.info(f'BOX {box_id}. Box is not active.')
+        return None
+    listener_supervisor.forget(box_id)
+    await start_owned_box(box)
+
+
+async def run_listener_service() -> None:
+    """Запустить прослушивание доли активных ящиков узла и обработку
+    команд веб-приложения."""
+    logger.info(f'NODE {listener_node.node_id}. Joining listeners.')
+    await listener_node.heartbeat()
+    await asyncio.sleep(settings.LISTENER_REBALANCE_INTERVAL)
+    run_in_background(run_periodically(
+        renew_node_leases,
+        settings.LISTENER_NODE_TTL // 3,
+    ))
+    run_in_background(run_periodically(
+        rebalance_listeners,
+        settings.LISTENER_REBALANCE_INTERVAL,
+    ))
+    run_in_background(run_periodically(
+        log_listener_stats,
+        settings.LISTENER_STATS_INTERVAL,
+    ))
+    try:
+        async for command in redis_client.listen(
+            settings.LISTENER_CONTROL_CHANNEL,
+            on_subscribe=filter_indexes.clear,
+        ):
+            run_in_background(handle_listener_command(command))
+    finally:
+        for task in list(pending_tasks):
+            task.cancel()
+        logger.info(
+            f'Stopping {len(listener_supervisor)} IMAP listeners.',
         )
-    logger.info('END on_startup_imap_starter')
+        box_ids = listener_supervisor.box_ids
+        await listener_supervisor.stop_all()
+        await listener_node.leave(box_ids)
+        parse_pool.shutdown()
@@ -5,11 +5,13 @@ from django.contrib import admin, messages
 from django.db.models.query import QuerySet
 from django.http import HttpRequest
 
-from user.models import BotUser
+from email_service.service import ServiceEmailBox
 from infrastructure.redis_service import redis_client
 from infrastructure.repository import Repository
+from user.models import BotUser
 
 repo = Repository()
+box_service = ServiceEmailBox()
 
 
 @admin.action(description='Удалить выбранных пользователей')
@@ -20,6 +22,12 @@ def delete_users(
 ) -> None:
     """Удаление выбранных пользователей."""
     for user in queryset:
+        boxes = async_to_sync(repo.box.get_all_user_boxes)(user.telegram_id)
+        for box in boxes:
+            async_to_sync(box_service.stop_listener)(
+                telegram_id=user.telegram_id,
+                box_id=box.id,
+            )
         redis_keys = async_to_sync(redis_client.get_all_keys)(
             pattern=settings.USER_KEYS_PATTERN.format(
                 telegram_id=user.telegram_id,
@@ -43,6 +51,10 @@ def deactivate_users(
         for box in boxes:
             box.is_active = False
             box.save()
+            async_to_sync(box_service.stop_listener)(
+                telegram_id=user.telegram_id,
+                box_id=box.id,
+            )
         redis_keys = async_to_sync(redis_client.get_all_keys)(
             pattern=settings.USER_KEYS_PATTERN.format(
                 telegram_id=user.telegram_id,